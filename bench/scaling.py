@@ -0,0 +1,265 @@
+# Scaling of the graph -> mesh pipeline stages. For synthetic graphs of
+# increasing size we record wall time and peak resident memory (RSS, so
+# that dolfin/PETSc/gmsh allocations count) of each stage, both in the same
+# run; RSS is sampled by a thread and the process high water mark catches
+# new peaks the sampling misses. Results are stored as JSON; scaling exponents are obtained by
+# fitting time ~ size**p per stage and runs can be compared against each other.
+#
+# python bench/scaling.py -family tree -sizes 10 12 14 16 -out tree.json
+# python bench/scaling.py -report tree.json -compare tree_old.json
+from graph_mesh.generators import murray_tree, random_lattice
+import networkx as nx
+import numpy as np
+import threading
+import resource
+import platform
+import tempfile
+import time
+import json
+import os
+
+
+pipeline_stages = ('swc2graph', 'mesh_graph', 'graph_adapt', 'color_branches',
+                   'greedy_color', 'compute_io_orientation', 'box_embed')
+
+
+def tree_graph(generations, seed=1):
+    '''Murray's law tree with random bifurcation planes'''
+    return murray_tree(generations, normal=None, seed=seed)
+
+
+def lattice_graph(N, seed=1):
+    '''Random subgraph of the unit square lattice'''
+    return random_lattice(N, seed=seed)
+
+
+families = {'tree': tree_graph, 'lattice': lattice_graph}
+
+
+def write_swc(graph, path):
+    '''Graph (a tree) as SWC file where nodes are numbered in BFS order'''
+    root = next(iter(graph.nodes))
+    order = [root] + [v for _, v in nx.bfs_edges(graph, root)]
+    index = {n: i for i, n in enumerate(order, 1)}
+    parent = dict(nx.bfs_predecessors(graph, root))
+
+    with open(path, 'w') as out:
+        for n in order:
+            x, y, z = (list(graph.nodes[n]['pos']) + [0, 0])[:3]
+            if n == root:
+                radius, ntype, p = 1.0, 1, -1
+            else:
+                data = graph.edges[(n, parent[n])]
+                radius, ntype, p = data['radius'], data.get('ntype', 1), index[parent[n]]
+            out.write(f'{index[n]} {ntype} {x} {y} {z} {radius} {p}\n')
+    return path
+
+
+def current_rss():
+    '''Resident memory (bytes) of this process; Linux, else the high water mark'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return max_rss()
+
+
+def max_rss():
+    '''High water mark of RSS (bytes; ru_maxrss is in kB on Linux)'''
+    return 1024*resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PeakRSS(object):
+    '''Peak RSS (bytes) while in the block and its increase over the start'''
+    __slots__ = ('interval', 'start', 'peak', '_high_water', '_stop', '_thread')
+
+    def __init__(self, interval=2E-3):
+        self.interval = interval
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        self._high_water = max_rss()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+        self.peak = max(self.peak, current_rss())
+        # A new high water mark was set by the block
+        high_water = max_rss()
+        if high_water > self._high_water:
+            self.peak = max(self.peak, high_water)
+
+    @property
+    def increase(self):
+        return self.peak - self.start
+
+
+def measure(f, *args, memory=True):
+    '''Result, wall time and (peak RSS, its increase) of f(*args) (one run)'''
+    if not memory:
+        then = time.perf_counter()
+        result = f(*args)
+        return result, time.perf_counter() - then, (None, None)
+
+    with PeakRSS() as rss:
+        then = time.perf_counter()
+        result = f(*args)
+        elapsed = time.perf_counter() - then
+
+    return result, elapsed, (rss.peak, rss.increase)
+
+
+def run_pipeline(graph, stages=pipeline_stages, memory=True, embed_max_edges=10**4):
+    '''
+    {stage: {time, peak_rss, rss_increase}} for the pipeline on graph.
+    Stages which are not selected run (unmeasured) only if later selected
+    stages need their output.
+    '''
+    from graph_mesh import mesh_graph, graph_adapt, color_branches
+    from graph_mesh.coloring import greedy_color
+    from graph_mesh.swc import swc2graph
+
+    records = {}
+    def record(stage, f, *args):
+        if stage not in stages:
+            return f(*args)
+        result, elapsed, (peak, increase) = measure(f, *args, memory=memory)
+        records[stage] = {'time': elapsed, 'peak_rss': peak, 'rss_increase': increase}
+        return result
+
+    needs_branches = {'greedy_color', 'compute_io_orientation'} & set(stages)
+    needs_mesh = needs_branches | ({'mesh_graph', 'graph_adapt', 'color_branches'} & set(stages))
+
+    if 'swc2graph' in stages and nx.is_tree(graph):
+        with tempfile.TemporaryDirectory() as tmp:
+            swc_path = write_swc(graph, os.path.join(tmp, 'graph.swc'))
+            record('swc2graph', swc2graph, swc_path)
+
+    if needs_mesh:
+        mesh, radii_f, _ = record('mesh_graph', mesh_graph, graph)
+
+    if 'graph_adapt' in stages:
+        record('graph_adapt', lambda: graph_adapt(radii_f, graph_adapt(mesh)))
+
+    if needs_branches or 'color_branches' in stages:
+        cell_f, _, _, color_connectivity = record('color_branches', color_branches, mesh)
+
+    if 'greedy_color' in stages:
+        record('greedy_color', greedy_color, cell_f, color_connectivity)
+
+    if 'compute_io_orientation' in stages:
+        from xii.meshing.embedded_mesh import TangentCurve
+        from graph_mesh.orientation import compute_io_orientation
+        from graph_mesh.registry import BranchSubmeshRegistry
+
+        tau = TangentCurve(mesh)
+        # Fresh registry so that we do not measure cache hits
+        record('compute_io_orientation',
+               lambda: compute_io_orientation(cell_f, tau, registry=BranchSubmeshRegistry()))
+
+    if 'box_embed' in stages and graph.number_of_edges() <= embed_max_edges:
+        from graph_mesh.embedding import box_embed
+
+        if len(graph.nodes[next(iter(graph.nodes))]['pos']) == 3:
+            record('box_embed', box_embed, graph, np.array([1.1, 1.1, 1.1]))
+
+    return {stage: records[stage] for stage in pipeline_stages if stage in records}
+
+
+def run(family, sizes, stages=pipeline_stages, memory=True, embed_max_edges=10**4):
+    '''Benchmark results for graphs of family with given size parameters'''
+    runs = []
+    for size in sizes:
+        graph = families[family](size)
+        nedges = graph.number_of_edges()
+
+        timings = run_pipeline(graph, stages=stages, memory=memory, embed_max_edges=embed_max_edges)
+        for stage, data in timings.items():
+            runs.append(dict(family=family, size=size, num_edges=nedges, stage=stage, **data))
+            print(f'{family} {nedges:>9} {stage:<24} {data["time"]:.3E}s peak RSS {data["peak_rss"]} '
+                  f'(+{data["rss_increase"]})')
+
+    return {'meta': {'python': platform.python_version(),
+                     'machine': platform.machine(),
+                     'node': platform.node(),
+                     'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'runs': runs}
+
+
+def scaling_exponents(results):
+    '''{(family, stage): p} where time ~ num_edges**p (least squares in log-log)'''
+    series = {}
+    for run in results['runs']:
+        series.setdefault((run['family'], run['stage']), []).append((run['num_edges'], run['time']))
+
+    exponents = {}
+    for key, data in series.items():
+        if len(data) < 2:
+            continue
+        n, t = np.array(data).T
+        exponents[key] = np.polyfit(np.log(n), np.log(np.maximum(t, 1E-12)), 1)[0]
+    return exponents
+
+
+def report(results, reference=None):
+    '''Scaling exponents and, given reference results, time ratios'''
+    exponents = scaling_exponents(results)
+    ref_exponents = scaling_exponents(reference) if reference is not None else {}
+
+    for (family, stage), p in sorted(exponents.items()):
+        line = f'{family:<8} {stage:<24} p = {p:.2f}'
+        if (family, stage) in ref_exponents:
+            line += f' (reference {ref_exponents[(family, stage)]:.2f})'
+        print(line)
+
+    if reference is not None:
+        ref_times = {(r['family'], r['stage'], r['num_edges']): r['time'] for r in reference['runs']}
+        for r in results['runs']:
+            key = (r['family'], r['stage'], r['num_edges'])
+            if key in ref_times:
+                print(f'{r["family"]:<8} {r["stage"]:<24} {r["num_edges"]:>9} x{r["time"]/ref_times[key]:.2f}')
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Scaling of pipeline stages')
+    parser.add_argument('-family', type=str, default='tree', choices=tuple(families))
+    # Generations for tree, N of the unit square for lattice
+    parser.add_argument('-sizes', type=int, nargs='+', default=[10, 12, 14, 16, 18, 20])
+    parser.add_argument('-stages', type=str, nargs='+', default=list(pipeline_stages), choices=pipeline_stages)
+    parser.add_argument('-no_memory', action='store_true')
+    parser.add_argument('-embed_max_edges', type=int, default=10**4)
+    parser.add_argument('-out', type=str, default='')
+    # Instead of running report on existing results
+    parser.add_argument('-report', type=str, default='')
+    parser.add_argument('-compare', type=str, default='')
+    args = parser.parse_args()
+
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+
+    if args.report:
+        with open(args.report) as f:
+            results = json.load(f)
+    else:
+        results = run(args.family, args.sizes, stages=args.stages, memory=not args.no_memory,
+                      embed_max_edges=args.embed_max_edges)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    report(results, reference)
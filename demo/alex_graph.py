@@ -146,11 +146,7 @@ if __name__ == '__main__':
 
     File('radii_f_coarse.pvd') << radii_f    
     # Refine the mesh
-    for _ in range(4):
-        rmesh = graph_adapt(mesh)
-        rradii_f = graph_adapt(radii_f, rmesh)
-
-        mesh, radii_f = rmesh, rradii_f
+    mesh, (radii_f, ), _ = graph_refine(mesh, [radii_f], level=4)
 
     File('radii_f_fine.pvd') << radii_f
 
@@ -23,14 +23,41 @@ def get_swc(subject):
 
     return swc_path
 
+
+def pseudostokes_forms(mesh):
+    '''
+    Form factory for branch blocks of the pseudo-Stokes problem with one
+    global pressure space on mesh; this is without the coupling. Defined
+    here so that worker processes can build it for their mesh.
+    '''
+    from xii import Restriction
+    import dolfin as df
+
+    Q = df.FunctionSpace(mesh, 'CG', 1)
+    p, q = df.TrialFunction(Q), df.TestFunction(Q)
+
+    Grad = lambda f, t: df.dot(df.grad(f), t)
+
+    def forms(color, data):
+        facet_f, branch, tau_branch = data
+
+        Vi = df.FunctionSpace(branch, 'CG', 2)
+        ui, vi = df.TrialFunction(Vi), df.TestFunction(Vi)
+
+        Rp_i, Rq_i = Restriction(p, branch), Restriction(q, branch)
+        dxi = df.Measure('dx', domain=branch)
+
+        return {(0, 0): df.inner(Grad(ui, tau_branch), Grad(vi, tau_branch))*dxi,
+                (0, 1): df.inner(Grad(vi, tau_branch), Rp_i)*dxi,
+                (1, 0): df.inner(Grad(ui, tau_branch), Rq_i)*dxi}
+    return forms
+
 # --------------------------------------------------------------------
 
 if __name__ == '__main__':
     from graph_mesh import *
-    from dolfin import File
     from graph_mesh.coloring import greedy_color
     from graph_mesh.swc import swc2graph
-    import dolfin as df
     import numpy as np
     
 
@@ -39,70 +66,56 @@ if __name__ == '__main__':
     G = swc2graph(swc_path)
 
     mesh, radii_f, ntype_f = mesh_graph(G)
-
-    File(f'{subject}_radii_f_coarse.pvd') << radii_f
     
     cell_f, bcolors, lcolors, terminals = color_branches(mesh)
-    File(f'{subject}_graph_colored.pvd') << cell_f
 
     sparse_color = greedy_color(cell_f, terminals)
-    File(f'{subject}_sparse_color.pvd') << sparse_color
-
-    # Save mesh as coordinates and cell 2 vertex matrix
-    coordinates = mesh.coordinates()
-    v2c = mesh.cells()    # Each row is a cell encoded in terms of its vertices
-
-    from scipy.io import savemat, loadmat
-
-    savemat('f{subject}.mat', {'coordinates': coordinates, 'cells': v2c})
-
-    data = loadmat('f{subject}.mat')
-
-    assert np.linalg.norm(coordinates-data['coordinates']) < 1E-13
-    assert np.linalg.norm(v2c-data['cells']) < 1E-13    
 
     # Just for illustration
-    from graph_mesh.orientation import compute_io_orientation
+    from graph_mesh.orientation import compute_io_orientation, endpoint_orientation
+    from graph_mesh.export import write_graph_h5, GraphH5
+    from graph_mesh.branching import BranchTraversal
+    from graph_mesh.assembly import assemble_branch_system, BranchSetup
+    from graph_mesh.registry import branch_registry
+    from graph_mesh import instrument
     from xii import *
-    import time
-    
-    tau = TangentCurve(mesh)
+    import logging
 
-    submesh_data = compute_io_orientation(cell_f, tau)
+    logging.basicConfig(level=logging.INFO)
+    instrument.enable(instrument.LoggerSink())
     
-    # There will be one global pressure space
-    Q = df.FunctionSpace(mesh, 'CG', 1)
-    p, q = df.TrialFunction(Q), df.TestFunction(Q)
-
-    Grad = lambda f, t: df.dot(df.grad(f), t)
+    tau = TangentCurve(mesh)
 
-    A01, A10 = 0, 0
+    submesh_data = compute_io_orientation(cell_f, tau, registry=branch_registry)
 
-    print('PSEUDOSTOKES ASSEMBLY')
-    then = time.time()
+    # Mesh and all the data in one file (with XDMF for ParaView)
+    write_graph_h5(f'{subject}.h5', mesh,
+                   {'radius': radii_f, 'ntype': ntype_f, 'branches': cell_f,
+                    'sparse_color': sparse_color, 'tangent': tau},
+                   traversal=BranchTraversal.from_cell_function(cell_f),
+                   color_connectivity=terminals,
+                   orientation=endpoint_orientation(cell_f, tau))
 
+    with GraphH5(f'{subject}.h5') as h5:
+        assert np.linalg.norm(mesh.coordinates() - h5.coordinates[()]) < 1E-13
+        assert np.all(mesh.cells() == h5.cells[()])
+        assert np.all(cell_f.array() == h5['cell_data/branches'][()])
+    
+    # There will be one global pressure space
     nbranches = len(bcolors)
-    # This is withough the coupling
-    a = np.zeros((nbranches+1, nbranches+1)).tolist()
-
     Qindex = nbranches
-    
-    for Vindex, color in enumerate(bcolors):
-        facet_f, branch, tau_branch = submesh_data[color]
-
-        Vi = df.FunctionSpace(branch, 'CG', 2)
-        ui, vi = df.TrialFunction(Vi), df.TestFunction(Vi)
-
-        Rp_i, Rq_i = Restriction(p, branch), Restriction(q, branch)
-        dxi = df.Measure('dx', domain=branch)
-
-        a[Vindex][Vindex] = df.inner(Grad(ui, tau_branch), Grad(vi, tau_branch))*dxi
-        a[Vindex][Qindex] = df.inner(Grad(vi, tau_branch), Rp_i)*dxi
-        a[Qindex][Vindex] = df.inner(Grad(ui, tau_branch), Rq_i)*dxi
-
-    A = ii_assemble(a)
 
-    print('Done', time.time()-then)
+    # Workers rebuild the mesh, branches and forms from arrays
+    with instrument.stage('pseudostokes_assembly', branches=nbranches):
+        system = assemble_branch_system(bcolors, submesh_data, pseudostokes_forms(mesh),
+                                        color_f=cell_f, color_connectivity=terminals,
+                                        setup=BranchSetup(cell_f, tau, pseudostokes_forms))
+    A = system.A
+
+    slowest = sorted(system.branch_times.items(), key=lambda item: -item[1])[:5]
+    instrument.emit({'stage': 'slowest_branches', 'branch_times': slowest,
+                     'imbalance': system.schedule.imbalance})
+    instrument.emit({'stage': 'branch_submeshes', **branch_registry.stats()})
 
     for Vindex, color in enumerate(bcolors):
         assert A[Vindex][Vindex].norm('linf') > 0
@@ -9,11 +9,7 @@ mesh, radii_f, _ = mesh_graph(G)
 File('edge_f.pvd') << edge_f
 File('radii_f_coarse.pvd') << radii_f    
 # Refine the mesh
-for _ in range(4):
-    rmesh = graph_adapt(mesh)
-    rradii_f = graph_adapt(radii_f, rmesh)
-        
-    mesh, radii_f = rmesh, rradii_f
+mesh, (radii_f, ), _ = graph_refine(mesh, [radii_f], level=4)
 
 File('radii_f_fine.pvd') << radii_f
 
@@ -1,3 +1,4 @@
+from .graph import ArrayGraph, as_array_graph
 from .meshing import mesh_graph
-from .adaptivity import graph_adapt
+from .adaptivity import graph_adapt, graph_refine
 from .branching import color_branches
@@ -1,34 +1,187 @@
+from .instrument import instrumented
+from .utils import dofmap_array
 import dolfin as df
+import numpy as np
 
 
 def graph_adapt(first, second=None):
-    '''Extend adapt to hand DG0 functions'''
+    '''
+    Extend adapt to hand DG0 functions. With second being the refined mesh
+    first can also be a list of fields (DG-k, CG-k functions and cell
+    functions) which are then transferred together.
+    '''
     if second is None:
         return df.adapt(first)
 
+    if isinstance(first, (list, tuple)):
+        return transfer_fields(first, second)
+
     try:
         return df.adapt(first, second)
     except TypeError:
-        assert first.function_space().ufl_element().family() == 'Discontinuous Lagrange'
         # Second assumed to be refined mesh of first
-        rmesh = second
-        
-        V = first.function_space()
-        dm = V.dofmap()
-        values = first.vector().get_local()
-
-        tdim = rmesh.topology().dim()
-        mapping = rmesh.data().array('parent_cell', tdim)
-
-        rV = df.FunctionSpace(rmesh, V.ufl_element())
-        rdm = rV.dofmap()
-        # This we want to fill
-        f = df.Function(rV)
-        rvalues = f.vector().get_local()
-        # Set my values taking those from the parent
-        for rc, c in enumerate(mapping):
-            rvalues[rdm.cell_dofs(rc)] = values[dm.cell_dofs(c)]
-
-        f.vector().set_local(rvalues)
-
+        f, = transfer_fields([first], second)
         return f
+
+
+@instrumented('graph_refine', counts=lambda r: {'cells': (r[-1] if isinstance(r, list) else r)[0].num_cells()})
+def graph_refine(mesh, fields=(), level=1, hierarchy=False):
+    '''
+    Uniform refinement of interval mesh where each cell is split into
+    2**level cells. DG0 functions and cell functions in fields are
+    transferred to the refined mesh. Returns the refined mesh, the fields
+    and map from refined cells to cells of mesh. With hierarchy we get
+    a list of these for levels 1, ..., level where the map goes to the
+    previous level.
+    '''
+    from .meshing import interval_mesh
+
+    assert mesh.topology().dim() == 1
+    assert level >= 1
+
+    x, cells = mesh.coordinates(), mesh.cells()
+    nvertices, ncells = len(x), len(cells)
+    # Parent cell values
+    cell_values = []
+    for field in fields:
+        if type(field) in _mesh_function_types:
+            assert field.dim() == 1
+            cell_values.append(field.array())
+        else:
+            V = field.function_space()
+            assert V.ufl_element().family() == 'Discontinuous Lagrange' and V.ufl_element().degree() == 0
+            cell_values.append(field.vector().get_local()[dofmap_array(V)])
+
+    levels = range(1, level+1) if hierarchy else (level, )
+
+    refined = []
+    for l in levels:
+        nchildren = 2**l
+        # Original vertices keep their numbering, the new ones in cell c
+        # follow as nvertices + c*(nchildren-1) + 0, ..., nchildren-2
+        t = np.arange(1, nchildren)/nchildren
+        x0, x1 = x[cells[:, 0]], x[cells[:, 1]]
+        new_x = (x0[:, np.newaxis] + t[np.newaxis, :, np.newaxis]*(x1-x0)[:, np.newaxis]).reshape((-1, x.shape[1]))
+
+        chain = np.empty((ncells, nchildren+1), dtype=np.int64)
+        chain[:, 0], chain[:, -1] = cells[:, 0], cells[:, 1]
+        chain[:, 1:-1] = nvertices + np.arange(ncells*(nchildren-1)).reshape((ncells, -1))
+        # Child c*nchildren + j is (chain[c, j], chain[c, j+1])
+        rcells = np.column_stack([chain[:, :-1].ravel(), chain[:, 1:].ravel()])
+        rmesh = interval_mesh(np.vstack([x, new_x]), rcells)
+
+        parent_cell = np.repeat(np.arange(ncells), nchildren)
+        rfields = []
+        for field, values in zip(fields, cell_values):
+            if type(field) in _mesh_function_types:
+                rfields.append(transfer_cell_function(field, rmesh, parent_cell))
+            else:
+                rV = df.FunctionSpace(rmesh, field.function_space().ufl_element())
+                rf = df.Function(rV)
+                rvalues = rf.vector().get_local()
+                rvalues[dofmap_array(rV)] = values[parent_cell]
+                rf.vector().set_local(rvalues)
+                rfields.append(rf)
+        # Relative to the previous level
+        if hierarchy and l > 1:
+            parent_cell = np.arange(len(rcells)) // 2
+
+        refined.append((rmesh, rfields, parent_cell))
+
+    return refined if hierarchy else refined[0]
+
+
+_mesh_function_types = {df.MeshFunctionSizet: 'size_t',
+                        df.MeshFunctionInt: 'int',
+                        df.MeshFunctionDouble: 'double',
+                        df.MeshFunctionBool: 'bool'}
+
+
+@instrumented('transfer_fields', counts=lambda r: {'fields': len(r)})
+def transfer_fields(fields, rmesh):
+    '''Transfer fields of the parent mesh to its refinement rmesh'''
+    tdim = rmesh.topology().dim()
+    # Read once for all the fields
+    parent_cell = np.asarray(rmesh.data().array('parent_cell', tdim), dtype=np.int64)
+    assert len(parent_cell) == rmesh.num_cells()
+
+    # Spaces, dofmaps and interpolation weights are shared between fields
+    # of the same space
+    cache = {}
+    transferred = []
+    for field in fields:
+        if type(field) in _mesh_function_types:
+            transferred.append(transfer_cell_function(field, rmesh, parent_cell))
+            continue
+
+        V = field.function_space()
+        key = (V.mesh().id(), V.ufl_element())
+        if key not in cache:
+            rV = df.FunctionSpace(rmesh, V.ufl_element())
+            cache[key] = {'rV': rV, 'dm': dofmap_array(V), 'rdm': dofmap_array(rV)}
+        data = cache[key]
+        dm, rdm = data['dm'], data['rdm']
+
+        values = field.vector().get_local()
+        rf = df.Function(data['rV'])
+        rvalues = rf.vector().get_local()
+
+        element = V.ufl_element()
+        if element.family() == 'Discontinuous Lagrange' and element.degree() == 0:
+            # Set my values taking those from the parent (regardless of value shape)
+            rvalues[rdm] = values[dm[parent_cell]]
+        else:
+            # Lagrange polynomial of the parent cell evaluated at child dofs
+            if 'weights' not in data:
+                data['weights'] = lagrange_weights(V, data['rV'], dm, rdm, parent_cell)
+            rvalues[rdm] = np.einsum('cij,cj->ci', data['weights'], values[dm[parent_cell]])
+
+        rf.vector().set_local(rvalues)
+        transferred.append(rf)
+
+    return transferred
+
+
+def transfer_cell_function(cell_f, rmesh, parent_cell):
+    '''Children inherit the value of the parent cell'''
+    tdim = rmesh.topology().dim()
+    assert cell_f.dim() == tdim
+
+    rcell_f = df.MeshFunction(_mesh_function_types[type(cell_f)], rmesh, tdim, 0)
+    rcell_f.array()[:] = cell_f.array()[parent_cell]
+
+    return rcell_f
+
+
+def lagrange_weights(V, rV, dm, rdm, parent_cell):
+    '''
+    For scalar Lagrange space on interval mesh compute for each refined
+    cell the (num_dofs x num_dofs) matrix of parent basis functions
+    evaluated at the child dof coordinates.
+    '''
+    mesh = V.mesh()
+    assert mesh.topology().dim() == 1
+    assert V.ufl_element().family() in ('Lagrange', 'Discontinuous Lagrange')
+    assert V.ufl_element().value_shape() == ()
+
+    # Parent cells as seen by the children
+    x = mesh.coordinates()
+    x0, x1 = (x[mesh.cells()[parent_cell, i]] for i in (0, 1))
+    tangent = x1 - x0
+    tangent /= np.sum(tangent**2, axis=1).reshape((-1, 1))
+    # Reference coordinates with respect to the parent cell
+    def reference(dof_x):
+        return np.einsum('cjd,cd->cj', dof_x - x0[:, np.newaxis], tangent)
+
+    s = reference(V.tabulate_dof_coordinates().reshape((V.dim(), -1))[dm[parent_cell]])
+    rs = reference(rV.tabulate_dof_coordinates().reshape((rV.dim(), -1))[rdm])
+
+    ndofs = s.shape[1]
+    # L_j(rs) = prod_{m != j} (rs - s_m)/(s_j - s_m)
+    weights = np.ones((len(parent_cell), ndofs, ndofs))
+    for j in range(ndofs):
+        for m in range(ndofs):
+            if m != j:
+                weights[:, :, j] *= (rs - s[:, m:m+1])/(s[:, j:j+1] - s[:, m:m+1])
+
+    return weights
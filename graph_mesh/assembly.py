@@ -0,0 +1,181 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+from .scheduling import partition_branches
+from .utils import dofmap_array
+from . import instrument
+import multiprocessing as mp
+import dolfin as df
+import time
+
+
+# Blocks of branch form factory: (0, 0) branch-branch, (0, 1) branch-global
+# and (1, 0) global-branch
+branch_blocks = ((0, 0), (0, 1), (1, 0))
+
+# Block system, {color: assembly time} and schedule of the branches
+BranchAssembly = namedtuple('BranchAssembly', ('A', 'branch_times', 'total_time', 'schedule'))
+
+
+def assemble_block(form):
+    '''Assembled (ii_assemble) form as matrix'''
+    from xii import ii_assemble, ii_convert
+
+    A = ii_assemble(form)
+    # Forms with restrictions can give lazy products
+    return A if isinstance(A, df.GenericMatrix) else ii_convert(A)
+
+
+def assemble_branches(colors, branches, form_factory):
+    '''Assemble blocks of the branches: {color: {block: matrix}}, {color: time}'''
+    blocks, times = {}, {}
+    for color in colors:
+        then = time.perf_counter()
+        with instrument.stage('branch_assembly', color=int(color)):
+            forms = form_factory(color, branches[color])
+            assert set(forms) <= set(branch_blocks), set(forms)
+            blocks[color] = {block: assemble_block(form) for block, form in forms.items()}
+        times[color] = time.perf_counter() - then
+    return blocks, times
+
+
+def matrix_to_csr(A):
+    '''(shape, indptr, indices, data) of the assembled matrix'''
+    indptr, indices, data = df.as_backend_type(A).mat().getValuesCSR()
+    return (A.size(0), A.size(1)), indptr, indices, data
+
+
+def csr_to_matrix(shape, indptr, indices, data):
+    '''PETScMatrix from CSR arrays'''
+    from petsc4py import PETSc
+
+    mat = PETSc.Mat().createAIJ(size=shape, csr=(indptr, indices, data), comm=PETSc.COMM_SELF)
+    mat.assemble()
+    return df.PETScMatrix(mat)
+
+
+class BranchSetup(object):
+    '''
+    Setup of worker processes from arrays: the mesh, the branch coloring
+    and the (DG0) tangent are rebuilt and forms(mesh) gives the form
+    factory. Branch data (compute_io_orientation) are built only for the
+    colors of the worker's tasks. Forms must be picklable, i.e. a module
+    level function.
+    '''
+    __slots__ = ('coordinates', 'cells', 'colors', 'tangent', 'forms')
+
+    def __init__(self, color_f, tau, forms):
+        mesh = color_f.mesh()
+        assert mesh.id() == tau.function_space().mesh().id()
+        assert tau.function_space().ufl_element().degree() == 0
+
+        self.coordinates = mesh.coordinates().copy()
+        self.cells = mesh.cells().copy()
+        self.colors = color_f.array().copy()
+        self.tangent = tau.vector().get_local()[dofmap_array(tau.function_space())]
+        self.forms = forms
+
+    def __call__(self):
+        from .meshing import interval_mesh
+        from .orientation import batched_io_orientation
+
+        mesh = interval_mesh(self.coordinates, self.cells)
+
+        color_f = df.MeshFunction('size_t', mesh, 1, 0)
+        color_f.array()[:] = self.colors
+
+        V = df.VectorFunctionSpace(mesh, 'DG', 0)
+        tau = df.Function(V)
+        values = tau.vector().get_local()
+        values[dofmap_array(V)] = self.tangent
+        tau.vector().set_local(values)
+
+        return (lambda colors: batched_io_orientation(color_f, tau, colors=colors)), self.forms(mesh)
+
+
+# In worker processes the branches and form factory are built once by setup
+_worker_context = None
+
+
+def _init_worker(setup):
+    global _worker_context
+    _worker_context = setup()
+
+
+def _assemble_branches_worker(colors):
+    branches, form_factory = _worker_context
+    # Branch data can be made on demand
+    if callable(branches):
+        branches = branches(colors)
+    blocks, times = assemble_branches(colors, branches, form_factory)
+    # Matrices travel as arrays
+    return ({color: {block: matrix_to_csr(A) for block, A in color_blocks.items()}
+             for color, color_blocks in blocks.items()},
+            times)
+
+
+def assemble_branch_system(colors, branches, form_factory, color_f=None, color_connectivity=None,
+                           global_form=None, workers=None, pool='process', setup=None,
+                           mp_context='spawn'):
+    '''
+    Block system of a coupled problem with one space per branch (colors
+    give the order of blocks) and one global space (last block). For branch
+    color form_factory(color, branches[color]) returns {block: form} with
+    blocks from branch_blocks; global_form is the global-global block.
+    Branches (e.g. output of compute_io_orientation) are assembled in
+    tasks which are bins of partition_branches (given color_f and
+    color_connectivity, otherwise colors are dealt round robin).
+
+    With pool='process' (default) the tasks run in a pool of workers which
+    call setup() once to build their own (branches, form_factory), e.g.
+    BranchSetup, and send back the matrices as CSR arrays. Branches and
+    form_factory of this process are not used then. With pool='serial'
+    the tasks run here one after another; threads would not help as
+    assembly (and FFC JIT) holds the GIL.
+
+    Returns BranchAssembly; A is block_mat.
+    '''
+    from block import block_mat
+
+    assert pool in ('process', 'serial')
+    assert pool == 'serial' or setup is not None, 'Process workers need setup, e.g. BranchSetup'
+
+    colors = list(colors)
+    workers = workers or mp.cpu_count()
+    nbins = max(1, min(workers, len(colors)))
+
+    schedule = None
+    if color_f is not None and color_connectivity is not None:
+        schedule = partition_branches(color_f, {c: color_connectivity[c] for c in colors}, nbins)
+        bins = [b.tolist() for b in schedule.bins if len(b)]
+    else:
+        bins = [colors[b::nbins] for b in range(nbins)]
+
+    then = time.perf_counter()
+    blocks, times = {}, {}
+    if pool == 'serial':
+        for b in bins:
+            bin_blocks, bin_times = assemble_branches(b, branches, form_factory)
+            blocks.update(bin_blocks)
+            times.update(bin_times)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context(mp_context),
+                                 initializer=_init_worker, initargs=(setup, )) as executor:
+            for bin_blocks, bin_times in executor.map(_assemble_branches_worker, bins):
+                blocks.update({color: {block: csr_to_matrix(*csr) for block, csr in color_blocks.items()}
+                               for color, color_blocks in bin_blocks.items()})
+                times.update(bin_times)
+
+    # Stitch
+    nbranches = len(colors)
+    A = [[0]*(nbranches+1) for _ in range(nbranches+1)]
+    for index, color in enumerate(colors):
+        for (i, j), block in blocks[color].items():
+            A[(index, nbranches)[i]][(index, nbranches)[j]] = block
+
+    if global_form is not None:
+        A[nbranches][nbranches] = assemble_block(global_form)
+
+    return BranchAssembly(A=block_mat(A),
+                          branch_times=times,
+                          total_time=time.perf_counter() - then,
+                          schedule=schedule)
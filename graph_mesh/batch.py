@@ -0,0 +1,169 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing as mp
+from .swc import swc2graph
+import traceback
+import json
+import glob
+import time
+import os
+
+
+# Stages of the pipeline in the order in which they run; each needs the previous
+pipeline_stages = ('graph', 'mesh', 'branches', 'coloring')
+
+
+def subject_name(swc_path):
+    '''BG0002.CNG.swc -> BG0002.CNG'''
+    subject = os.path.basename(swc_path)
+    return subject[:-len('.swc')] if subject.endswith('.swc') else subject
+
+
+def process_subject(swc_path, out_dir, stages=pipeline_stages):
+    '''
+    Run the pipeline for one SWC file writing the results to
+    `out_dir/<subject>.h5`. Returns record with timings of the stages.
+    '''
+    assert all(stage in pipeline_stages for stage in stages)
+    # Everything up to the last requested stage
+    stages = pipeline_stages[:max(pipeline_stages.index(stage) for stage in stages)+1]
+
+    subject = subject_name(swc_path)
+    timings, outputs = {}, {}
+
+    def timed(stage, f, *args):
+        then = time.perf_counter()
+        result = f(*args)
+        timings[stage] = time.perf_counter() - then
+        return result
+
+    graph = timed('graph', swc2graph, swc_path)
+    # FEniCS is only needed from here on
+    if 'mesh' in stages:
+        from .coloring import greedy_color
+        from .branching import color_branches
+        from .meshing import mesh_graph
+        import dolfin as df
+
+        mesh, radii_f, ntype_f = timed('mesh', mesh_graph, graph)
+        outputs.update({'radius': radii_f, 'ntype': ntype_f})
+    if 'branches' in stages:
+        cell_f, _, _, color_connectivity = timed('branches', color_branches, mesh)
+        outputs['branches'] = cell_f
+    if 'coloring' in stages:
+        outputs['sparse_color'] = timed('coloring', greedy_color, cell_f, color_connectivity)
+
+    path = None
+    if 'mesh' in stages:
+        then = time.perf_counter()
+        path = os.path.join(out_dir, f'{subject}.h5')
+        with df.HDF5File(mesh.mpi_comm(), path, 'w') as out:
+            out.write(mesh, '/mesh')
+            for name, f in outputs.items():
+                out.write(f, f'/{name}')
+        timings['output'] = time.perf_counter() - then
+
+    return {'subject': subject,
+            'swc': swc_path,
+            'output': path,
+            'datasets': sorted(outputs),
+            'timings': timings}
+
+
+def process_subject_isolated(swc_path, out_dir, stages=pipeline_stages, mp_context='spawn'):
+    '''process_subject in a process of its own so that its crash hurts no other'''
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context(mp_context)) as pool:
+        return pool.submit(process_subject, swc_path, out_dir, stages).result()
+
+
+def failure_record(swc_path, attempt, e):
+    '''Record of subject failed with exception e'''
+    return {'subject': subject_name(swc_path),
+            'swc': swc_path,
+            'status': 'failed',
+            'attempts': attempt,
+            'error': ''.join(traceback.format_exception(type(e), e, e.__traceback__))}
+
+
+def run_batch(swc_dir, out_dir, stages=pipeline_stages, workers=None, retries=1,
+              pattern='*.swc', mp_context='spawn'):
+    '''
+    Run the pipeline over SWC files in swc_dir using a process pool of
+    workers. Failed subjects are retried (in a fresh pool) at most retries
+    times and then skipped. A worker which dies (e.g. segfault) breaks the
+    pool and with it all its pending subjects; these are rerun each in its
+    own process so that only the crashing one fails. Writes manifest.json
+    with per subject timings and failures to out_dir and returns it.
+    '''
+    swc_paths = sorted(glob.glob(os.path.join(swc_dir, pattern)))
+    os.makedirs(out_dir, exist_ok=True)
+
+    records = {}
+    then = time.perf_counter()
+
+    pending, attempt = swc_paths, 0
+    while pending and attempt <= retries:
+        attempt += 1
+        failed, broken = [], []
+        # A worker which dies breaks the pool, so each attempt has its own
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context(mp_context)) as pool:
+            futures = {pool.submit(process_subject, path, out_dir, stages): path for path in pending}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    record = future.result()
+                    record.update({'status': 'ok', 'attempts': attempt})
+                except BrokenProcessPool:
+                    # Not known yet if this one crashed
+                    broken.append(path)
+                    continue
+                except Exception as e:
+                    record = failure_record(path, attempt, e)
+                    failed.append(path)
+                records[path] = record
+
+        if broken:
+            # Threads only wait for the isolated processes
+            with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as isolation:
+                futures = {isolation.submit(process_subject_isolated, path, out_dir, stages, mp_context): path
+                           for path in broken}
+                for future in as_completed(futures):
+                    path = futures[future]
+                    try:
+                        record = future.result()
+                        record.update({'status': 'ok', 'attempts': attempt})
+                    except Exception as e:
+                        record = failure_record(path, attempt, e)
+                        failed.append(path)
+                    records[path] = record
+        pending = failed
+
+    manifest = {'stages': list(stages),
+                'workers': workers or os.cpu_count(),
+                'retries': retries,
+                'total_time': time.perf_counter() - then,
+                'num_ok': sum(record['status'] == 'ok' for record in records.values()),
+                'num_failed': sum(record['status'] == 'failed' for record in records.values()),
+                'subjects': [records[path] for path in swc_paths]}
+
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as out:
+        json.dump(manifest, out, indent=2)
+
+    return manifest
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run graph-mesh pipeline over directory of SWC files')
+    parser.add_argument('swc_dir', type=str)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('-stages', type=str, nargs='+', default=list(pipeline_stages), choices=pipeline_stages)
+    parser.add_argument('-workers', type=int, default=None)
+    parser.add_argument('-retries', type=int, default=1)
+    args = parser.parse_args()
+
+    manifest = run_batch(args.swc_dir, args.out_dir, stages=args.stages, workers=args.workers,
+                         retries=args.retries)
+    print(f'Done {manifest["num_ok"]} ok, {manifest["num_failed"]} failed in {manifest["total_time"]:.2f}s')
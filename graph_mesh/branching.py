@@ -1,74 +1,213 @@
-from copy import deepcopy
+from scipy.sparse.csgraph import connected_components, breadth_first_order
+from .instrument import instrumented
+from .utils import vertex_to_cell_csr
+import scipy.sparse as sp
+import numpy as np
 import dolfin as df
 
 
-def color_branches(mesh):
+@instrumented('color_branches', counts=lambda r: {'cells': len(r[0].array()), 'branches': len(r[1]), 'loops': len(r[2])})
+def color_branches(mesh, with_cells=False):
     '''Start/end is a terminal
 
     We return a cell function where branches and loops are colored,
-    a list of brach colors, list of loop colors and map from terminal 
-    vertices to connected cells.
+    a list of brach colors, list of loop colors and map from branch color
+    to its (end, start) vertices. Optionally map from color to cells of the
+    branch ordered from start to end.
     '''
     assert mesh.topology().dim() == 1
 
-    _, v2c = mesh.init(0, 1), mesh.topology()(0, 1)
-    c2v = mesh.topology()(1, 0)
+    colors, branch_colors, loop_colors, color_connectivity, branch_cells = decompose_branches(
+        mesh.cells(), mesh.num_vertices())
 
-    terminals = {v: set(v2c(v)) for v in range(mesh.num_vertices()) if len(v2c(v)) != 2}
-    
     cell_f = df.MeshFunction('size_t', mesh, 1, 0)
-    if not terminals:
-        cell_f.set_all(1)
-        return cell_f, [], [1]
-
-    def next_vertex(c, v, c2v=c2v):
-        v0, v1 = c2v(c)
-        return v1 if v == v0 else v0
-
-    def next_cell(v, c, v2c=v2c):
-        c0, c1 = v2c(v)
-        return c1 if c == c0 else c0
-    
-    values = cell_f.array()
-    branch_colors, loop_colors, color = [], [], 0
-    # It will be useful to talk about end vertices of colored branches
-    color_connectivity = {}
-
-    exhausted = False
-    while not exhausted:
-        vertex = max(terminals, key=lambda v: terminals[v])
-        vertex_cells = terminals[vertex]
-
-        exhausted = len(vertex_cells) == 0
-        # The idea is to walk from vertex following the cell
-        while vertex_cells:
-            link_cell = vertex_cells.pop()
-            v0 = vertex
-            
-            branch = [link_cell]
-            # v0 --
-            while next_vertex(link_cell, v0) not in terminals:
-                # -- v0 ==
-                v0 = next_vertex(link_cell, v0)
-                # Because we have not terminal, ==
-                link_cell = next_cell(v0, link_cell)
-                branch.append(link_cell)
-            # Once we reached the terminal
-            v0 = next_vertex(link_cell, v0)
-
-            color += 1
-            if v0 == vertex:
-                loop_colors.append(color)
-            else:
-                branch_colors.append(color)
-            values[branch] = color
-
-            color_connectivity[color] = (v0, vertex)
-            
-            # Preclude leaving from vertex in a look
-            link_cell in vertex_cells and vertex_cells.remove(link_cell)
-            # If we arrived to some other terminal, we don't want to leave from it by the
-            # same way we arrived
-            v0 in terminals and link_cell in terminals[v0] and terminals[v0].remove(link_cell)
+    cell_f.array()[:] = colors
 
+    if with_cells:
+        return cell_f, branch_colors, loop_colors, color_connectivity, branch_cells
     return cell_f, branch_colors, loop_colors, color_connectivity
+
+
+def decompose_branches(cells, num_vertices=None):
+    '''
+    Split graph given by cells (ncells x 2 array of vertex indices) into
+    branches, i.e. chains of cells connected through vertices with 2 cells
+    and terminating in terminals (vertices with other than 2 cells). Loops
+    are branches whose start and end coincide; components without terminals
+    are cut open at a vertex of their first cell.
+
+    Returns cell colors (starting from 1), branch colors, loop colors,
+    {color: (end, start)} and {color: cells ordered from start to end}.
+    The work is O(N) in the number of cells.
+    '''
+    colors, ordered_cells, offsets, start_vertices, end_vertices = _decompose_chains(cells, num_vertices)
+
+    branch_colors, loop_colors, color_connectivity, branch_cells = [], [], {}, {}
+    for index, (start, end) in enumerate(zip(start_vertices.tolist(), end_vertices.tolist())):
+        color = index + 1
+
+        (loop_colors if start == end else branch_colors).append(color)
+        color_connectivity[color] = (end, start)
+        branch_cells[color] = ordered_cells[offsets[index]:offsets[index+1]]
+
+    return colors, branch_colors, loop_colors, color_connectivity, branch_cells
+
+
+def _decompose_chains(cells, num_vertices=None, cut_vertices=None):
+    '''
+    Array core of decompose_branches. Returns cell colors, cells ordered by
+    color and then from start to end, offsets of the colors (color-1) in
+    the ordered cells and the start and end vertices of colors. Cycles are
+    preferably cut at (the smallest of) cut_vertices.
+    '''
+    cells = np.asarray(cells, dtype=np.int64)
+    ncells = len(cells)
+    offsets, v2c = vertex_to_cell_csr(cells, num_vertices)
+    degree = np.diff(offsets)
+
+    # Link cells across vertices of degree 2
+    link_vertices, = np.where(degree == 2)
+    cell_graph = _cell_graph(v2c, offsets, link_vertices, ncells)
+    ncomps, comp = connected_components(cell_graph, directed=False)
+
+    # Components without terminals are cycles. We cut them open at the first
+    # vertex of the smallest cell
+    is_free = degree != 2
+    has_terminal = np.bincount(comp, weights=np.any(is_free[cells], axis=1), minlength=ncomps) > 0
+    cycles, = np.where(~has_terminal)
+    if len(cycles):
+        first_cell = np.full(ncomps, ncells, dtype=np.int64)
+        np.minimum.at(first_cell, comp, np.arange(ncells))
+        cut = cells[first_cell, 0]
+
+        if cut_vertices is not None:
+            nvertices = len(degree)
+            preferred = np.full(ncomps, nvertices, dtype=np.int64)
+            is_preferred = np.asarray(cut_vertices)[cells]
+            np.minimum.at(preferred, np.repeat(comp, 2)[is_preferred.ravel()], cells[is_preferred])
+            cut = np.where(preferred < nvertices, preferred, cut)
+
+        is_free[cut[cycles]] = True
+        link_vertices, = np.where(~is_free)
+
+    # Each component is now a path with exactly two free (cell, vertex) ends
+    free_cells, free_local = np.where(is_free[cells])
+    free_vertices = cells[free_cells, free_local]
+    assert np.all(np.bincount(comp[free_cells], minlength=ncomps) == 2)
+    # We start from the smaller vertex (cell breaks ties in loops)
+    order = np.lexsort((free_cells, free_vertices, comp[free_cells]))
+    start_cells, _ = free_cells[order].reshape((-1, 2)).T
+    start_vertices, end_vertices = free_vertices[order].reshape((-1, 2)).T
+
+    # Colors are assigned in the order of start vertices
+    comp_colors = np.empty(ncomps, dtype=np.int64)
+    comp_order = np.lexsort((start_cells, start_vertices))
+    comp_colors[comp_order] = np.arange(1, ncomps+1)
+    colors = comp_colors[comp]
+
+    # Breadth first search from a virtual source linked to all start cells
+    # visits cells of each path in order
+    source = ncells
+    cell_graph = _cell_graph(v2c, offsets, link_vertices, ncells, source_links=start_cells)
+    visited = breadth_first_order(cell_graph, source, directed=False, return_predecessors=False)
+    visited = visited[visited != source]
+    assert len(visited) == ncells
+    ordered_cells = visited[np.argsort(colors[visited], kind='stable')]
+
+    color_offsets = np.zeros(ncomps+1, dtype=np.int64)
+    np.cumsum(np.bincount(colors, minlength=ncomps+1)[1:], out=color_offsets[1:])
+
+    return (colors, ordered_cells, color_offsets,
+            start_vertices[comp_order], end_vertices[comp_order])
+
+
+class BranchTraversal(object):
+    '''
+    Ordered traversal of all the branches of a coloring (each color is
+    a chain of cells, e.g. as computed by color_branches) built once. For
+    every branch we store in CSR arrays its cells ordered from start to end,
+    their orientation (True if the cell's (v0, v1) is in walk direction)
+    and the ordered vertices (the loops repeat start vertex at the end).
+    '''
+    __slots__ = ('colors', 'cell_offsets', 'cells', 'orientations', 'vertex_offsets', 'vertices', '_index')
+
+    def __init__(self, cells, colors):
+        cells = np.asarray(cells, dtype=np.int64)
+        colors = np.asarray(colors, dtype=np.int64)
+        # Chains are decomposed in the graph where each color has its own copy
+        # of the vertex
+        pairs, pair_ids = np.unique(np.column_stack([np.repeat(colors, 2), cells.ravel()]),
+                                    axis=0, return_inverse=True)
+        # Loops hanging on terminals of the mesh are cut there
+        degree = np.bincount(cells.ravel())
+        _, ordered, offsets, start_pairs, _ = _decompose_chains(pair_ids.reshape((-1, 2)),
+                                                                cut_vertices=degree[pairs[:, 1]] != 2)
+        # Chains are numbered in the order of start pairs, i.e. by color
+        self.colors = pairs[start_pairs, 0]
+        assert len(np.unique(self.colors)) == len(self.colors), 'Color is not a single chain'
+
+        self.cell_offsets, self.cells = offsets, ordered
+        # Entering vertex of each cell is shared with the previous one
+        # or for the first cell it is the start
+        ordered_cells = cells[ordered]
+        previous = np.roll(ordered_cells, 1, axis=0)
+        first_shared = (ordered_cells[:, 0] == previous[:, 0]) | (ordered_cells[:, 0] == previous[:, 1])
+        enter = np.where(first_shared, ordered_cells[:, 0], ordered_cells[:, 1])
+        enter[offsets[:-1]] = pairs[start_pairs, 1]
+
+        self.orientations = ordered_cells[:, 0] == enter
+        exit = np.where(self.orientations, ordered_cells[:, 1], ordered_cells[:, 0])
+        # Each branch has one vertex more than cells
+        nbranches = len(self.colors)
+        self.vertex_offsets = offsets + np.arange(nbranches+1)
+        self.vertices = np.empty(len(exit) + nbranches, dtype=np.int64)
+        is_exit = np.ones(len(self.vertices), dtype=bool)
+        is_exit[self.vertex_offsets[:-1]] = False
+        self.vertices[is_exit] = exit
+        self.vertices[~is_exit] = enter[offsets[:-1]]
+
+        self._index = np.full(np.max(self.colors)+1 if nbranches else 1, -1, dtype=np.int64)
+        self._index[self.colors] = np.arange(nbranches)
+
+    @classmethod
+    def from_cell_function(cls, color_f):
+        '''Index for coloring given as cell function'''
+        mesh = color_f.mesh()
+        assert mesh.topology().dim() == 1 and color_f.dim() == 1
+
+        return cls(mesh.cells(), color_f.array())
+
+    def _branch(self, color):
+        index = self._index[color] if 0 <= color < len(self._index) else -1
+        assert index >= 0, f'No branch of color {color}'
+        return index
+
+    def branch_cells(self, color):
+        '''Ordered cells of the branch'''
+        i = self._branch(color)
+        return self.cells[self.cell_offsets[i]:self.cell_offsets[i+1]]
+
+    def branch_orientations(self, color):
+        '''Is the cell (v0, v1) in the walk direction'''
+        i = self._branch(color)
+        return self.orientations[self.cell_offsets[i]:self.cell_offsets[i+1]]
+
+    def branch_vertices(self, color):
+        '''Ordered vertices of the branch'''
+        i = self._branch(color)
+        return self.vertices[self.vertex_offsets[i]:self.vertex_offsets[i+1]]
+
+    def __len__(self):
+        return len(self.colors)
+
+
+def _cell_graph(v2c, offsets, link_vertices, ncells, source_links=None):
+    '''Cells are connected if they share a link vertex'''
+    c0, c1 = v2c[offsets[link_vertices]], v2c[offsets[link_vertices]+1]
+    if source_links is None:
+        return sp.csr_matrix((np.ones(len(c0)), (c0, c1)), shape=(ncells, ncells))
+    # Extra vertex linked to the given cells
+    c0 = np.r_[c0, np.full(len(source_links), ncells)]
+    c1 = np.r_[c1, source_links]
+
+    return sp.csr_matrix((np.ones(len(c0)), (c0, c1)), shape=(ncells+1, ncells+1))
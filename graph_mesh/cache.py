@@ -0,0 +1,242 @@
+from .meshing import graph_arrays, mesh_graph, interval_mesh, cell_data_function
+from .branching import color_branches
+from .coloring import greedy_color
+from .operators import cell_values
+from collections.abc import Mapping
+import dolfin as df
+import numpy as np
+import hashlib
+import shutil
+import json
+import os
+
+
+def digest(*arrays):
+    '''Hash of the arrays (their dtype, shape and data)'''
+    h = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(str((array.dtype.str, array.shape)).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def graph_digest(graph):
+    '''Hash of positions, edges, radius and ntype of the graph'''
+    return digest(*graph_arrays(graph))
+
+
+# Version of each stage's artifact (arrays and their layout); bump it when
+# they change so that stale artifacts are not served
+stage_versions = {'mesh': 1, 'branches': 1, 'coloring': 1, 'orientation': 1}
+
+
+class Artifact(Mapping):
+    '''
+    Arrays of an artifact directory (one .npy each) which are only loaded,
+    as read-only memory maps, when used
+    '''
+    __slots__ = ('path', 'names')
+
+    def __init__(self, path):
+        self.path = path
+        self.names = sorted(name[:-len('.npy')] for name in os.listdir(path) if name.endswith('.npy'))
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        return np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r')
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+class ArtifactCache(object):
+    '''
+    On-disk cache of arrays derived from graphs. Each artifact is a
+    directory of .npy files named by stage and the hash of its inputs,
+    parameters and the versions of the format and the stage; it is read
+    as a lazy mapping of arrays (see Artifact). Once the total size
+    exceeds max_bytes the least recently used artifacts are removed.
+    '''
+    # Of the layout on disk
+    version = 2
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+        self.hits, self.misses = 0, 0
+
+    def key(self, stage, inputs, **params):
+        '''Key of stage computed from inputs (hash) with parameters'''
+        versions = (self.version, stage_versions.get(stage, 0))
+        return hashlib.sha256(json.dumps([stage, versions, inputs, sorted(params.items())],
+                                         default=str).encode()).hexdigest()
+
+    def path(self, stage, key):
+        return os.path.join(self.root, f'{stage}-{key}')
+
+    def get(self, stage, key):
+        '''Artifact (mapping of arrays) or None'''
+        path = self.path(stage, key)
+        if not os.path.isdir(path):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # Recently used is protected from eviction
+        os.utime(path)
+        return Artifact(path)
+
+    def put(self, stage, key, **arrays):
+        '''Store arrays as artifact'''
+        path = self.path(stage, key)
+        # Write is atomic
+        tmp = f'{path}.{os.getpid()}.tmp'
+        os.makedirs(tmp)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), array)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            # Someone else stored it meanwhile
+            shutil.rmtree(tmp)
+
+        self.evict()
+        return arrays
+
+    def get_or_compute(self, stage, key, compute):
+        '''Artifact for key, compute (returns dict of arrays) is called on miss'''
+        artifact = self.get(stage, key)
+        if artifact is None:
+            artifact = self.put(stage, key, **compute())
+        return artifact
+
+    def entries(self):
+        '''(path, size, last access) of artifacts oldest first'''
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path) and '.tmp' not in name:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((path, size, os.stat(path).st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        '''Remove least recently used artifacts to fit max_bytes'''
+        if self.max_bytes is None:
+            return 0
+
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        count = 0
+        # Keep at least the newest
+        while size > self.max_bytes and len(entries) > 1:
+            path, nbytes, _ = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            size -= nbytes
+            count += 1
+        return count
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+    def stats(self):
+        '''Hits and misses of this session, artifacts and their size by stage'''
+        by_stage = {}
+        for path, size, _ in self.entries():
+            stage = os.path.basename(path).split('-')[0]
+            count, nbytes = by_stage.get(stage, (0, 0))
+            by_stage[stage] = (count+1, nbytes+size)
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': sum(count for count, _ in by_stage.values()),
+                'bytes': sum(nbytes for _, nbytes in by_stage.values()),
+                'max_bytes': self.max_bytes,
+                'stages': by_stage}
+
+
+# Stages whose artifacts are cached. Each returns the reconstructed output
+# together with the key so that the following stages can chain on it
+
+def cached_mesh_graph(cache, graph, graph_key=None):
+    '''
+    mesh_graph. The artifact is the mesh (coordinates, cells) and its cell
+    data so a hit only rebuilds the dolfin objects. The graph is identified
+    by graph_key (e.g. digest of its SWC file) or by the hash of its arrays;
+    with graph_key a hit does not touch the graph at all.
+    '''
+    key = cache.key('mesh', graph_key if graph_key is not None else graph_digest(graph))
+
+    data = cache.get('mesh', key)
+    if data is None:
+        mesh, radius_f, ntype_f = mesh_graph(graph)
+        cache.put('mesh', key, coordinates=mesh.coordinates(), cells=mesh.cells(),
+                  radius=cell_values(radius_f), ntype=cell_values(ntype_f))
+        return (mesh, radius_f, ntype_f), key
+
+    mesh = interval_mesh(data['coordinates'], data['cells'])
+    radius_f, ntype_f = (cell_data_function(mesh, data[name]) for name in ('radius', 'ntype'))
+
+    return (mesh, radius_f, ntype_f), key
+
+
+def cached_color_branches(cache, mesh, mesh_key):
+    '''color_branches'''
+    key = cache.key('branches', mesh_key)
+
+    def compute():
+        cell_f, branch_colors, loop_colors, color_connectivity = color_branches(mesh)
+        colors = np.array(sorted(color_connectivity), dtype=np.int64)
+        ends = np.array([color_connectivity[c] for c in colors], dtype=np.int64).reshape((-1, 2))
+        return {'cell_colors': cell_f.array(),
+                'branch_colors': np.array(branch_colors, dtype=np.int64),
+                'loop_colors': np.array(loop_colors, dtype=np.int64),
+                'colors': colors,
+                'ends': ends}
+
+    data = cache.get_or_compute('branches', key, compute)
+
+    cell_f = df.MeshFunction('size_t', mesh, 1, 0)
+    cell_f.array()[:] = data['cell_colors']
+    color_connectivity = {c: tuple(e) for c, e in zip(data['colors'].tolist(), data['ends'].tolist())}
+
+    return (cell_f, data['branch_colors'].tolist(), data['loop_colors'].tolist(), color_connectivity), key
+
+
+def cached_greedy_color(cache, cell_f, color_connectivity, branches_key, strategy='largest_first'):
+    '''greedy_color'''
+    key = cache.key('coloring', branches_key, strategy=strategy)
+
+    data = cache.get_or_compute(
+        'coloring', key,
+        lambda: {'colors': greedy_color(cell_f, color_connectivity, strategy=strategy).array()})
+
+    sparse_color = df.MeshFunction('size_t', cell_f.mesh(), 1, 0)
+    sparse_color.array()[:] = data['colors']
+
+    return sparse_color, key
+
+
+def cached_endpoint_orientation(cache, cell_f, tau, branches_key):
+    '''
+    Orientation data of compute_io_orientation, i.e. endpoint_orientation
+    (submeshes are not cached here, see registry)
+    '''
+    from .orientation import endpoint_orientation
+
+    key = cache.key('orientation', branches_key, tau=digest(tau.vector().get_local()))
+
+    def compute():
+        return dict(zip(('colors', 'vertices', 'cells', 'markers'), endpoint_orientation(cell_f, tau)))
+
+    data = cache.get_or_compute('orientation', key, compute)
+
+    return (data['colors'], data['vertices'], data['cells'], data['markers']), key
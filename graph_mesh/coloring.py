@@ -1,51 +1,163 @@
 from collections import defaultdict
-import networkx as nx
+from .instrument import stage
+import scipy.sparse as sp
+import heapq
 import numpy as np
 import dolfin as df
+import time
 
 
-def greedy_color(color_f, color_connectivity):
+def greedy_color(color_f, color_connectivity, strategy='largest_first'):
     '''
-    Let cell_f mark uniquely the mesh branches. As this might be many 
-    colors the coloring computed here strives to reduce that by having 
+    Let cell_f mark uniquely the mesh branches. As this might be many
+    colors the coloring computed here strives to reduce that by having
     no two branches that are connected be colored with the same color
     '''
     mesh = color_f.mesh()
     assert mesh.geometry().dim() > 1 and mesh.topology().dim() == 1
     assert color_f.dim() == mesh.topology().dim()
-    
-    dG = nx.Graph()
-    dG.add_edges_from(color_connectivity[c] for c in sorted(color_connectivity))
-    # We want to build a graph where branch is a node and edges represent
-    # branch connectivity.
-    G = nx.line_graph(dG)
-    # Then the job is to color the graph ...
-    colormap = nx.algorithms.coloring.greedy_color(G)
-
-    # Unique coloring from branch encoding in terms of vertices
-    icc = {tuple(sorted(v)): c for c, v in color_connectivity.items()}
-
-    color_f = color_f.array()
-    sparse_color = 1*color_f  # A copy
-
-    greedy_colors = set()
-    # ... and translate the coloring
-    for key, color in colormap.items():
-        try:
-            branch, = np.where(color_f == icc[key])
-        except KeyError:
-            key = tuple(reversed(key))
-            branch, = np.where(color_f == icc[key])
-        sparse_color[branch] = color+1
-        # Just to keep track of how many we ended up using
-        greedy_colors.add(color+1)
-
-        del icc[key]
-    assert not icc
-
-    ans = df.MeshFunction('size_t', mesh, 1, 0)
-    ans.array()[:] = sparse_color
-
-    print(f'Greedy brach coloring color reduction {len(color_connectivity)} -> {len(greedy_colors)}')
-    
+
+    with stage('greedy_color', strategy=strategy) as event:
+        branch_colors, greedy_colors, elapsed = color_branch_graph(color_connectivity, strategy)
+        # Translate the coloring with a lookup table
+        lookup = np.zeros(max(branch_colors)+1 if len(branch_colors) else 1, dtype=np.uintp)
+        lookup[branch_colors] = greedy_colors
+
+        ans = df.MeshFunction('size_t', mesh, 1, 0)
+        ans.array()[:] = lookup[color_f.array()]
+        # Color reduction
+        event.update({'coloring_time': elapsed,
+                      'branches': len(color_connectivity),
+                      'colors': len(np.unique(greedy_colors))})
     return ans
+
+
+def branch_adjacency(color_connectivity):
+    '''
+    Branch colors and sparse adjacency matrix of the graph where branches
+    are nodes and edges represent branches sharing an end vertex
+    '''
+    branch_colors = np.array(sorted(color_connectivity), dtype=np.int64)
+    ends = np.array([color_connectivity[c] for c in branch_colors], dtype=np.int64).reshape((-1, 2))
+    nbranches = len(branch_colors)
+    # Branch to end vertex incidence; loops have one end vertex
+    _, ends = np.unique(ends, return_inverse=True)
+    ends = ends.reshape((-1, 2))
+    incidence = sp.csr_matrix((np.ones(2*nbranches), (np.repeat(np.arange(nbranches), 2), ends.ravel())))
+    incidence.data[:] = 1
+
+    adjacency = (incidence @ incidence.T).tocsr()
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+
+    return branch_colors, adjacency
+
+
+def color_branch_graph(color_connectivity, strategy='largest_first'):
+    '''
+    Greedy coloring of branch adjacency. Returns branch colors, their new
+    colors (from 1) and the time taken by the coloring
+    '''
+    assert strategy in strategies, (strategy, tuple(strategies))
+
+    branch_colors, adjacency = branch_adjacency(color_connectivity)
+    # Work with lists of neighbors
+    offsets, neighbors = adjacency.indptr.tolist(), adjacency.indices.tolist()
+    adjacency = [neighbors[offsets[i]:offsets[i+1]] for i in range(len(branch_colors))]
+
+    then = time.perf_counter()
+    greedy_colors = np.array(strategies[strategy](adjacency), dtype=np.int64) + 1
+    elapsed = time.perf_counter() - then
+
+    return branch_colors, greedy_colors, elapsed
+
+
+def compare_strategies(color_connectivity):
+    '''{strategy: (number of colors, time)} for coloring the branch graph'''
+    report = {}
+    for strategy in strategies:
+        _, greedy_colors, elapsed = color_branch_graph(color_connectivity, strategy)
+        report[strategy] = (len(np.unique(greedy_colors)), elapsed)
+    return report
+
+
+def _smallest_free(used):
+    '''Smallest color (from 0) not in used'''
+    color = 0
+    while color in used:
+        color += 1
+    return color
+
+
+def _color_in_order(adjacency, order):
+    '''Greedy coloring visiting nodes in order'''
+    colors = [-1]*len(adjacency)
+    for node in order:
+        colors[node] = _smallest_free({colors[n] for n in adjacency[node]})
+    return colors
+
+
+def largest_first(adjacency):
+    '''Nodes are colored in order of decreasing degree'''
+    order = sorted(range(len(adjacency)), key=lambda node: -len(adjacency[node]))
+    return _color_in_order(adjacency, order)
+
+
+def smallest_last(adjacency):
+    '''
+    Nodes are colored in reverse of the order in which we repeatedly remove
+    node of smallest degree (bucket queue, O(V + E))
+    '''
+    degree = [len(neighbors) for neighbors in adjacency]
+    # Dicts as sets with O(1) pop
+    buckets = defaultdict(dict)
+    for node, d in enumerate(degree):
+        buckets[d][node] = None
+
+    removed, order, d = [False]*len(adjacency), [], 0
+    while len(order) < len(adjacency):
+        # Removal decreases degrees by one so the minimum moves back by at most 1
+        d = max(d-1, 0)
+        while not buckets[d]:
+            d += 1
+        node, _ = buckets[d].popitem()
+        removed[node] = True
+        order.append(node)
+
+        for n in adjacency[node]:
+            if not removed[n]:
+                del buckets[degree[n]][n]
+                degree[n] -= 1
+                buckets[degree[n]][n] = None
+
+    return _color_in_order(adjacency, reversed(order))
+
+
+def dsatur(adjacency):
+    '''
+    Color next the node with most distinctly colored neighbors (ties broken
+    by degree); heap with lazy deletion
+    '''
+    colors = [-1]*len(adjacency)
+    neighbor_colors = [set() for _ in adjacency]
+
+    heap = [(0, -len(neighbors), node) for node, neighbors in enumerate(adjacency)]
+    heapq.heapify(heap)
+    while heap:
+        saturation, _, node = heapq.heappop(heap)
+        # Stale entry
+        if colors[node] != -1 or -saturation != len(neighbor_colors[node]):
+            continue
+
+        color = colors[node] = _smallest_free(neighbor_colors[node])
+        for n in adjacency[node]:
+            if colors[n] == -1 and color not in neighbor_colors[n]:
+                neighbor_colors[n].add(color)
+                heapq.heappush(heap, (-len(neighbor_colors[n]), -len(adjacency[n]), n))
+
+    return colors
+
+
+strategies = {'largest_first': largest_first,
+              'dsatur': dsatur,
+              'smallest_last': smallest_last}
@@ -0,0 +1,389 @@
+from dolfin import Mesh, Function, FunctionSpace, MPI, compile_cpp_code
+from .graph import as_array_graph
+from .instrument import instrumented
+from .utils import dofmap_array
+from collections import namedtuple
+import numpy as np
+import os
+
+
+# Each rank passes its block of vertices and cells (in global numbering)
+# and dolfin's MeshPartitioning distributes them with ghosting
+_build_distributed_code = '''
+#include <pybind11/pybind11.h>
+#include <pybind11/eigen.h>
+#include <dolfin/mesh/Mesh.h>
+#include <dolfin/mesh/CellType.h>
+#include <dolfin/mesh/LocalMeshData.h>
+#include <dolfin/mesh/MeshPartitioning.h>
+
+namespace py = pybind11;
+
+using Coordinates = Eigen::Matrix<double, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>;
+using Cells = Eigen::Matrix<std::int64_t, Eigen::Dynamic, 2, Eigen::RowMajor>;
+using Indices = Eigen::Matrix<std::int64_t, Eigen::Dynamic, 1>;
+
+void build_distributed_interval_mesh(std::shared_ptr<dolfin::Mesh> mesh,
+                                     const Eigen::Ref<const Coordinates> x,
+                                     const Eigen::Ref<const Indices> vertex_indices,
+                                     std::int64_t num_global_vertices,
+                                     const Eigen::Ref<const Cells> cells,
+                                     const Eigen::Ref<const Indices> cell_indices,
+                                     std::int64_t num_global_cells,
+                                     const Eigen::Ref<const Indices> cell_partition,
+                                     std::string ghost_mode)
+{
+  dolfin::LocalMeshData data(mesh->mpi_comm());
+
+  const std::size_t nvertices = x.rows(), gdim = x.cols();
+  data.geometry.dim = gdim;
+  data.geometry.num_global_vertices = num_global_vertices;
+  data.geometry.vertex_coordinates.resize(boost::extents[nvertices][gdim]);
+  data.geometry.vertex_indices.resize(nvertices);
+  for (std::size_t i = 0; i < nvertices; ++i)
+  {
+    data.geometry.vertex_indices[i] = vertex_indices(i);
+    for (std::size_t j = 0; j < gdim; ++j)
+      data.geometry.vertex_coordinates[i][j] = x(i, j);
+  }
+
+  const std::size_t ncells = cells.rows();
+  data.topology.dim = 1;
+  data.topology.cell_type = dolfin::CellType::Type::interval;
+  data.topology.num_vertices_per_cell = 2;
+  data.topology.num_global_cells = num_global_cells;
+  data.topology.cell_vertices.resize(boost::extents[ncells][2]);
+  data.topology.global_cell_indices.resize(ncells);
+  for (std::size_t c = 0; c < ncells; ++c)
+  {
+    data.topology.global_cell_indices[c] = cell_indices(c);
+    data.topology.cell_vertices[c][0] = cells(c, 0);
+    data.topology.cell_vertices[c][1] = cells(c, 1);
+  }
+  // Empty partition means that the dolfin's partitioner is used
+  data.topology.cell_partition.assign(cell_partition.data(), cell_partition.data() + cell_partition.size());
+
+  dolfin::MeshPartitioning::build_distributed_mesh(*mesh, data, ghost_mode);
+}
+
+PYBIND11_MODULE(SIGNATURE, m)
+{
+  m.def("build_distributed_interval_mesh", &build_distributed_interval_mesh);
+}
+'''
+
+_build_distributed = None
+
+
+# This rank's block of the graph: positions of vertices [vertex_offsets[rank],
+# vertex_offsets[rank+1]) and edges (in global vertex numbering) with their
+# radius and ntype which are the cells [cell_offsets[rank], cell_offsets[rank+1])
+GraphBlock = namedtuple('GraphBlock', ('pos', 'edges', 'radius', 'ntype', 'vertex_offsets', 'cell_offsets'))
+
+
+def block_range(n, rank, size):
+    '''Range [first, last) of the rank's block when n items are split evenly'''
+    first = rank*(n//size) + min(rank, n % size)
+    return first, first + n//size + (rank < n % size)
+
+
+def block_offsets(comm, count):
+    '''Offsets of blocks (size + 1) when this rank has count items'''
+    return np.r_[0, np.cumsum(comm.allgather(int(count)))].astype(np.int64)
+
+
+def block_owners(offsets, indices):
+    '''Rank holding each of the global indices'''
+    return np.searchsorted(offsets, indices, side='right') - 1
+
+
+def _split_by_owner(offsets, indices, *arrays):
+    '''Order (by owner) and per rank chunks of the arrays'''
+    owners = block_owners(offsets, indices)
+    order = np.argsort(owners, kind='stable')
+    bounds = np.cumsum(np.bincount(owners, minlength=len(offsets)-1))[:-1]
+
+    return order, [np.split(array[order], bounds) for array in arrays]
+
+
+def send_to_owners(comm, offsets, indices, *values):
+    '''
+    Global indices (and values attached to them) received by this rank from
+    all the ranks which sent those of its block
+    '''
+    _, chunks = _split_by_owner(offsets, indices, indices, *values)
+
+    return tuple(np.concatenate(comm.alltoall(chunk)) for chunk in chunks)
+
+
+def fetch(comm, offsets, local_values, indices):
+    '''
+    Values at global indices of an array distributed in blocks given by
+    offsets where this rank holds local_values
+    '''
+    order, (chunks, ) = _split_by_owner(offsets, indices, indices)
+    # Ask the owners ...
+    requests = comm.alltoall(chunks)
+    # ... and answer them
+    first = offsets[comm.rank]
+    answers = comm.alltoall([local_values[request - first] for request in requests])
+
+    values = np.empty((len(indices), ) + local_values.shape[1:], dtype=local_values.dtype)
+    values[order] = np.concatenate(answers)
+    return values
+
+
+def branch_labels(comm, block):
+    '''
+    Label of each local cell (the smallest global cell index) of its branch,
+    i.e. chain of cells connected over vertices of degree 2. Computed with
+    collectives only: vertex owners link the cells at their degree 2
+    vertices and labels are found by min-label hooking and pointer jumping
+    over the cells' blocks.
+    '''
+    rank = comm.rank
+    vertex_offsets, cell_offsets = block.vertex_offsets, block.cell_offsets
+    v0, v1 = vertex_offsets[rank], vertex_offsets[rank+1]
+    c0, c1 = cell_offsets[rank], cell_offsets[rank+1]
+
+    cells = np.arange(c0, c1, dtype=np.int64)
+    # Owners of the vertices see their cells
+    vertices, vertex_cells = send_to_owners(comm, vertex_offsets, block.edges.ravel(), np.repeat(cells, 2))
+    degree = np.bincount(vertices - v0, minlength=v1 - v0)
+
+    linked = degree[vertices - v0] == 2
+    vertices, vertex_cells = vertices[linked], vertex_cells[linked]
+    # Pair up the 2 cells of each such vertex
+    links = vertex_cells[np.argsort(vertices, kind='stable')].reshape((-1, 2))
+
+    label = cells.copy()
+    while True:
+        # Hook the larger label of linked cells to the smaller one
+        pair = fetch(comm, cell_offsets, label, links.ravel()).reshape((-1, 2))
+        lo, hi = pair.min(axis=1), pair.max(axis=1)
+        differ = lo != hi
+        if not comm.allreduce(int(np.any(differ))):
+            break
+        hi, lo = send_to_owners(comm, cell_offsets, hi[differ], lo[differ])
+        np.minimum.at(label, hi - c0, lo)
+        # Shortcut until labels point to roots
+        while True:
+            root = fetch(comm, cell_offsets, label, label)
+            if not comm.allreduce(int(np.any(root != label))):
+                break
+            label = root
+    return label
+
+
+def cell_destinations(comm, block, partition):
+    '''
+    Destination rank of each local cell. With 'vertices' cells follow the
+    block owning their first vertex; with 'branches' whole branches (chains
+    between terminals) are assigned to ranks in balanced contiguous blocks.
+    '''
+    assert partition in ('vertices', 'branches')
+
+    if partition == 'vertices':
+        return block_owners(block.vertex_offsets, block.edges[:, 0])
+
+    size, rank = comm.size, comm.rank
+    cell_offsets = block.cell_offsets
+    c0, c1 = cell_offsets[rank], cell_offsets[rank+1]
+    num_cells = cell_offsets[-1]
+
+    label = branch_labels(comm, block)
+    # Branch sizes are counted by the owner of the label (branch root) ...
+    roots, = send_to_owners(comm, cell_offsets, label)
+    branch_size = np.bincount(roots - c0, minlength=c1 - c0)
+    # ... and the branches are laid out in the order of roots so the branch
+    # ends in the block where its midpoint cell falls
+    first = block_offsets(comm, np.sum(branch_size))[rank]
+    mid = first + np.cumsum(branch_size) - branch_size + branch_size//2
+    branch_rank = np.minimum(mid*size // max(num_cells, 1), size-1)
+
+    return fetch(comm, cell_offsets, branch_rank, label)
+
+
+def graph_block(graph, comm=None):
+    '''
+    GraphBlock of the rank when graph (networkx, ArrayGraph or SWCData),
+    available on every rank, is split evenly
+    '''
+    comm = comm or MPI.comm_world
+    graph = as_array_graph(graph)
+    rank, size = comm.rank, comm.size
+
+    v0, v1 = block_range(graph.num_nodes, rank, size)
+    c0, c1 = block_range(graph.num_edges, rank, size)
+
+    return GraphBlock(pos=graph.pos[v0:v1],
+                      edges=graph.edges[c0:c1].astype(np.int64),
+                      radius=graph.radius[c0:c1],
+                      ntype=graph.ntype[c0:c1],
+                      vertex_offsets=block_offsets(comm, v1 - v0),
+                      cell_offsets=block_offsets(comm, c1 - c0))
+
+
+def read_swc_block(swc_file, comm=None):
+    '''
+    GraphBlock of the rank from its share of the lines of SWC file (by
+    bytes). Same numbering and checks as read_swc/swc_edges with the edges
+    of the rank being those of its (child) nodes.
+    '''
+    comm = comm or MPI.comm_world
+    rank, size = comm.rank, comm.size
+
+    # Lines starting in [start, stop) are ours
+    start, stop = block_range(os.path.getsize(swc_file), rank, size)
+    with open(swc_file, 'rb') as f:
+        if start > 0:
+            # Skip what remains of the line started by the previous rank
+            f.seek(start - 1)
+            f.readline()
+        data = f.read(max(stop - f.tell(), 0))
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+
+    lines = [line for line in data.splitlines() if line.strip() and not line.lstrip().startswith(b'#')]
+    table = np.loadtxt(lines, ndmin=2, dtype=float) if lines else np.zeros((0, 7))
+    assert table.shape[1] == 7, f'Expected 7 columns in SWC file, got {table.shape[1]}'
+
+    index = table[:, 0].astype(np.int64)
+    ntype = table[:, 1].astype(np.int64)
+    parent = table[:, 6].astype(np.int64)
+    assert np.all(index == table[:, 0]) and np.all(parent == table[:, 6])
+    assert np.all(ntype == table[:, 1])
+
+    vertex_offsets = block_offsets(comm, len(index))
+    num_nodes = vertex_offsets[-1]
+    # Contiguous numbering from 1 over all the ranks
+    assert num_nodes
+    assert np.all(index == vertex_offsets[rank] + np.arange(1, len(index)+1))
+    assert np.all((parent == -1) | ((1 <= parent) & (parent <= num_nodes)))
+    assert np.all(parent != index)
+
+    child, = np.where(parent != -1)
+    return GraphBlock(pos=np.ascontiguousarray(table[:, 2:5]),
+                      edges=np.column_stack([index[child]-1, parent[child]-1]),
+                      radius=table[child, 5],
+                      ntype=ntype[child],
+                      vertex_offsets=vertex_offsets,
+                      cell_offsets=block_offsets(comm, len(child)))
+
+
+def exchange_cell_data(comm, cell_data, cell_offsets, global_cells):
+    '''
+    Values for global_cells (needed here) when the rank holds cell_data of
+    its block of cell_offsets.
+    '''
+    return fetch(comm, cell_offsets, cell_data, global_cells)
+
+
+def distributed_cell_function(mesh, local_data):
+    '''DG0 function with values of local cells (incl. ghosts) of the mesh'''
+    V = FunctionSpace(mesh, 'DG', 0)
+    f = Function(V)
+
+    values = f.vector().get_local()
+    dofs = dofmap_array(V).ravel()
+    # Ghost cells have dofs of other ranks
+    owned = dofs < len(values)
+    values[dofs[owned]] = local_data[owned]
+    f.vector().set_local(values)
+    f.vector().apply('insert')
+
+    return f
+
+
+@instrumented('mesh_graph_distributed', counts=lambda r: {'local_cells': r[0].num_cells()})
+def mesh_graph_distributed(block, comm=None, partition='branches', ghost_mode='shared_vertex'):
+    '''
+    1d mesh of graph distributed over comm (default is MPI.comm_world).
+    Each rank only passes on its GraphBlock (see read_swc_block; graph_block
+    splits a graph every rank has) and dolfin's MeshPartitioning sends
+    vertices and cells to their destinations with ghost cells at the shared
+    vertices (ghost_mode). Destinations are by 'branches' or 'vertices' (see
+    cell_destinations); with partition=None dolfin's graph partitioner
+    decides. Radius and ntype are returned as distributed DG0 functions.
+    '''
+    global _build_distributed
+
+    comm = comm or MPI.comm_world
+    if not isinstance(block, GraphBlock):
+        block = graph_block(block, comm)
+    rank = comm.rank
+
+    vertex_offsets, cell_offsets = block.vertex_offsets, block.cell_offsets
+    v0, v1 = vertex_offsets[rank], vertex_offsets[rank+1]
+    c0, c1 = cell_offsets[rank], cell_offsets[rank+1]
+    assert len(block.pos) == v1 - v0 and len(block.edges) == c1 - c0
+
+    if partition is None:
+        destinations = np.zeros(0, dtype=np.int64)
+    else:
+        destinations = cell_destinations(comm, block, partition)
+
+    if _build_distributed is None:
+        _build_distributed = compile_cpp_code(_build_distributed_code).build_distributed_interval_mesh
+
+    mesh = Mesh(comm)
+    _build_distributed(mesh,
+                       np.ascontiguousarray(block.pos, dtype=float),
+                       np.arange(v0, v1, dtype=np.int64), vertex_offsets[-1],
+                       np.ascontiguousarray(block.edges, dtype=np.int64),
+                       np.arange(c0, c1, dtype=np.int64), cell_offsets[-1],
+                       np.ascontiguousarray(destinations, dtype=np.int64), ghost_mode)
+
+    # Cell data is fetched from the ranks holding the blocks
+    global_cells = np.asarray(mesh.topology().global_indices(1), dtype=np.int64)
+    cell_data = np.column_stack([block.radius, block.ntype])
+    local_data = exchange_cell_data(comm, cell_data, cell_offsets, global_cells)
+
+    return (mesh, ) + tuple(distributed_cell_function(mesh, data) for data in local_data.T)
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    # mpirun -np 4 python -m graph_mesh.distributed
+    from graph_mesh.generators import murray_tree
+    from dolfin import assemble, dx
+    import tempfile
+    import time
+
+    comm = MPI.comm_world
+    # Rank 0 writes the SWC file and every rank reads its part of it. The
+    # tree's edge i is (parent, i+1) so nodes are in SWC order
+    graph = murray_tree(14, normal=None, seed=1, as_arrays=True)
+    swc_file = comm.bcast(tempfile.mkstemp(suffix='.swc')[1] if comm.rank == 0 else None)
+    if comm.rank == 0:
+        assert np.all(graph.edges[:, 1] == np.arange(1, graph.num_nodes))
+        parent = np.r_[-1, graph.edges[:, 0]+1]
+        radius = np.r_[graph.radius[0], graph.radius]
+        np.savetxt(swc_file, np.column_stack([np.arange(1, graph.num_nodes+1), np.ones(graph.num_nodes),
+                                              graph.pos, radius, parent]),
+                   fmt=['%d', '%d', '%.16g', '%.16g', '%.16g', '%.16g', '%d'])
+    comm.barrier()
+
+    block = read_swc_block(swc_file, comm)
+    num_edges = block.cell_offsets[-1]
+    assert num_edges == graph.num_edges
+
+    lengths = np.linalg.norm(graph.pos[graph.edges[:, 1]] - graph.pos[graph.edges[:, 0]], axis=1)
+    for partition in ('branches', 'vertices', None):
+        then = time.perf_counter()
+        mesh, radius_f, ntype_f = mesh_graph_distributed(block, comm, partition=partition)
+        elapsed = MPI.max(comm, time.perf_counter() - then)
+
+        assert mesh.num_entities_global(1) == graph.num_edges
+        assert mesh.num_entities_global(0) == graph.num_nodes
+        # Data is where it should be
+        assert abs(assemble(radius_f*dx(domain=mesh)) - np.dot(lengths, graph.radius)) < 1E-10*np.dot(lengths, graph.radius)
+
+        owned = mesh.topology().ghost_offset(1)
+        counts = comm.gather(owned, root=0)
+        if comm.rank == 0:
+            print(f'{partition} cells per rank {counts} in {elapsed:.2f}s')
+
+    comm.barrier()
+    if comm.rank == 0:
+        os.remove(swc_file)
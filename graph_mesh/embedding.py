@@ -1,15 +1,86 @@
 from gmshnics import msh_gmsh_model, mesh_from_gmsh
 from .utils import PCA_axis, rotation_matrix
+from .graph import ArrayGraph, as_array_graph
+from . import instrument
+import networkx as nx
 import numpy as np
 import gmsh
+import time
+
+
+def min_area_direction(y):
+    '''
+    Unit direction of side of minimum area rectangle around 2d points. By
+    rotating calipers one side is along a convex hull edge; None if the
+    points are degenerate.
+    '''
+    from scipy.spatial import ConvexHull, QhullError
+
+    try:
+        hull = y[ConvexHull(y).vertices]
+    except QhullError:
+        return None
+
+    edges = np.roll(hull, -1, axis=0) - hull
+    u = edges/np.linalg.norm(edges, axis=1)[:, None]
+    v = np.column_stack([-u[:, 1], u[:, 0]])
+    # Rectangle of every edge at once
+    area = np.ptp(hull @ u.T, axis=0)*np.ptp(hull @ v.T, axis=0)
+    return u[np.argmin(area)]
+
+
+def oriented_bbox(x, iterations=4):
+    '''
+    Oriented bounding box of 3d points: lower and upper bounds of the points
+    in the frame (columns are the axes; right handed). We start from the
+    principal axes and for each axis in turn replace the other two by
+    the minimum area rectangle of the projected points as long as volume
+    decreases. The axis aligned frame is used if it is not worse.
+    '''
+    from scipy.spatial import ConvexHull, QhullError
+
+    _, _, frame = PCA_axis(x)
+    if np.linalg.det(frame) < 0:
+        frame[:, 2] *= -1
+    # Only the hull matters
+    try:
+        x = x[ConvexHull(x).vertices]
+    except QhullError:
+        pass
+
+    volume = lambda frame: np.prod(np.ptp(x @ frame, axis=0))
+
+    best = volume(frame)
+    for _ in range(iterations):
+        improved = False
+        for k in range(3):
+            # Cyclic so that the frame stays right handed
+            plane = frame[:, [(k+1) % 3, (k+2) % 3]]
+            u = min_area_direction(x @ plane)
+            if u is None:
+                continue
+            candidate = frame.copy()
+            candidate[:, (k+1) % 3] = plane @ u
+            candidate[:, (k+2) % 3] = plane @ np.array([-u[1], u[0]])
+
+            candidate_volume = volume(candidate)
+            if candidate_volume < best*(1 - 1E-10):
+                frame, best, improved = candidate, candidate_volume, True
+        if not improved:
+            break
+
+    if volume(np.eye(3)) <= best:
+        frame = np.eye(3)
+    y = x @ frame
+
+    return np.min(y, axis=0), np.max(y, axis=0), frame
 
 
 def get_bbox(graph, scaling, align):
-    '''Bounding box'''
+    '''Bounding box (origin and edge vectors), aligned is oriented bounding box'''
     assert np.all(scaling >= 1)
     
-    nodes = graph.nodes
-    mesh_coordinates = np.row_stack([nodes[n]['pos'] for n in nodes])
+    mesh_coordinates = as_array_graph(graph).pos
 
     if align == False:
         ll, uu = np.min(mesh_coordinates, axis=0), np.max(mesh_coordinates, axis=0)
@@ -24,25 +95,129 @@ def get_bbox(graph, scaling, align):
                 dx[1]*np.array([0, 1, 0]),
                 dx[2]*np.array([0, 0, 1]))
 
-    raise ValueError
+    with instrument.stage('oriented_bbox', num_nodes=len(mesh_coordinates)) as event:
+        ll, uu, frame = oriented_bbox(mesh_coordinates)
+
+        dx = uu - ll
+        shift = 0.5*(scaling - 1)
+        origin = frame @ (ll - shift*dx)
+        dx = scaling*dx
+
+        volume = np.prod(dx)
+        aabb_volume = np.prod(scaling*np.ptp(mesh_coordinates, axis=0))
+        event.update({'volume': float(volume),
+                      'aabb_volume': float(aabb_volume),
+                      'saved': float(1 - volume/aabb_volume) if aabb_volume > 0 else 0.})
+
+    return (origin,
+            dx[0]*frame[:, 0],
+            dx[1]*frame[:, 1],
+            dx[2]*frame[:, 2])
+
+
+# Gmsh codes of 3d meshing algorithms
+algorithms3d = {'delaunay': 1, 'frontal': 4, 'mmg3d': 7, 'rtree': 9, 'hxt': 10}
+
+
+def set_meshing_options(algorithm3d=None, num_threads=None, optimize=None,
+                        optimize_netgen=None, smoothing=None):
+    '''
+    Set options of (initialized) gmsh for 3d meshing, None keeps the default.
+    Number of threads is used by the parallel meshers, in particular `hxt`.
+    Optimize and optimize_netgen toggle optimization of tetrahedra and
+    smoothing is the number of smoothing passes.
+    '''
+    if algorithm3d is not None:
+        gmsh.option.setNumber('Mesh.Algorithm3D', algorithms3d[algorithm3d])
+
+    if num_threads is not None:
+        gmsh.option.setNumber('General.NumThreads', num_threads)
+        gmsh.option.setNumber('Mesh.MaxNumThreads3D', num_threads)
+
+    if optimize is not None:
+        gmsh.option.setNumber('Mesh.Optimize', int(optimize))
+
+    if optimize_netgen is not None:
+        gmsh.option.setNumber('Mesh.OptimizeNetgen', int(optimize_netgen))
+
+    if smoothing is not None:
+        gmsh.option.setNumber('Mesh.Smoothing', smoothing)
+
+
+def dedupe_points(x, edges, tol=1E-10):
+    '''
+    Merge points which are within tol relative to the size of the point
+    cloud (transitively, i.e. clusters of such points become one). Return
+    unique points and unique lines between them (lines whose ends were
+    merged are dropped).
+    '''
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+    import scipy.sparse as sp
+
+    size = np.max(np.ptp(x, axis=0)) if len(x) else 1.
+    size = size if size > 0 else 1.
+    pairs = cKDTree(x).query_pairs(tol*size, output_type='ndarray') if len(x) else np.zeros((0, 2), dtype=int)
+
+    adjacency = sp.coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(x), len(x)))
+    _, labels = connected_components(adjacency, directed=False)
+    # Cluster is represented by its first point
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+
+    points = x[first]
+    lines = inverse.ravel()[edges]
+    lines = lines[lines[:, 0] != lines[:, 1]]
+    lines = np.unique(np.sort(lines, axis=1), axis=0)
+
+    return points, lines
+
 
+def add_graph_geometry(fac, graph, tol=1E-10):
+    '''Points and lines of graph (any node ids) in the gmsh geometry factory'''
+    graph = as_array_graph(graph)
+
+    points, lines = dedupe_points(graph.pos, graph.edges, tol=tol)
+
+    vertices = np.fromiter((fac.addPoint(*p) for p in points.tolist()), dtype=np.int64, count=len(points))
+    lines = [fac.addLine(p, q) for p, q in vertices[lines].tolist()]
+
+    return lines
+
+
+def box_embed(graph, scaling, align=False, view=False, args=[], meshing_options=None,
+              tol=1E-10, return_timings=False, resample=None, validate=False):
+    '''
+    Embded graph in its [aligned] bounding box. Meshing options are passed
+    to `set_meshing_options`. With resample (dict of `resample_chains`
+    arguments) the chains of the graph are coarsened before embedding.
+    With validate crossing/touching edges raise ValueError before meshing.
+    Optionally return timings of the stages.
+    '''
+    timings = {}
+    then = time.perf_counter()
+    # Convert once for bbox and geometry
+    graph = as_array_graph(graph)
+    if resample is not None:
+        from .simplify import resample_chains
+        graph, _, _ = resample_chains(graph, **resample)
+
+    if validate:
+        from .validation import check_graph
+        check_graph(graph, duplicate_tol=tol)
 
-def box_embed(graph, scaling, align=False, view=False, args=[]):
-    '''Embded graph in its [aligned] bounding box'''
     origin, dx, dy, dz = get_bbox(graph, scaling, align=align)
-    print(origin, dx, dy, dx)
-    
+
     gmsh.initialize(args)
+    set_meshing_options(**(meshing_options or {}))
+    # We dedupe points ourselves (dedupe_points merges all within tol)
+    gmsh.option.setNumber('Geometry.AutoCoherence', 0)
 
     model = gmsh.model
     fac = model.geo
     # Start from the outside
     entities = addBox(fac, origin, dx, dy, dz)
 
-    nodes = graph.nodes
-    vertices = [fac.addPoint(*nodes[n]['pos']) for n in nodes]
-
-    lines = [fac.addLine(vertices[p-1], vertices[q-1]) for p, q in graph.edges]
+    lines = add_graph_geometry(fac, graph, tol=tol)
     fac.synchronize()
     # Mark them for lookup
     model.addPhysicalGroup(1, lines, 1)
@@ -52,16 +227,33 @@ def box_embed(graph, scaling, align=False, view=False, args=[]):
     # Embedd the lines
     model.mesh.embed(1, lines, 3, vol)    
     fac.synchronize()
+    timings['geometry'] = time.perf_counter() - then
 
     if view:
         gmsh.fltk.initialize()
         gmsh.fltk.run()
 
+    then = time.perf_counter()
     nodes, topologies = msh_gmsh_model(model, 3)
+    timings['mesh'] = time.perf_counter() - then
+
+    then = time.perf_counter()
     mesh, entity_functions = mesh_from_gmsh(nodes, topologies)    
+    timings['convert'] = time.perf_counter() - then
 
     gmsh.finalize()
 
+    if instrument.is_enabled():
+        instrument.emit({'stage': 'box_embed',
+                         'time': sum(timings.values()),
+                         'bbox': [np.asarray(v).tolist() for v in (origin, dx, dy, dz)],
+                         'bbox_volume': float(abs(np.linalg.det(np.array([dx, dy, dz])))),
+                         'vertices': mesh.num_vertices(),
+                         'cells': mesh.num_cells(),
+                         **timings})
+
+    if return_timings:
+        return mesh, entity_functions, timings
     return mesh, entity_functions
 
 
@@ -109,25 +301,33 @@ def addBox(fac, origin, dx, dy, dz):
 
 
 
-def stl_embed(graph, stl_path, scale=0.8, view=False, args=[]):
-    '''Returns modified graph that fits "better" to the STL bounding box'''
-    gmsh.initialize(args)
-
-    gmsh.merge(stl_path)
-    
-    model = gmsh.model
-    fac = model.geo
+def stl_embed(graph, stl_path, scale=None, margin=0., max_scale=1., placement_steps=3,
+              view=False, args=[], validate=False):
+    '''
+    Returns modified graph that fits "better" to the STL bounding box.
+    Networkx graph is modified in place, otherwise new ArrayGraph is returned.
+    With validate crossing/touching edges raise ValueError before meshing.
+
+    The graph is aligned with the principal axis of the surface. Without
+    scale we fit the largest scale (<= max_scale) and placement such that
+    all graph vertices are inside the surface and at least margin away
+    from it (see surface.fit_inside).
+    '''
+    from .surface import read_stl, TriangleBVH, fit_inside
 
-    vol = fac.addVolume([fac.addSurfaceLoop([1])])
-    fac.synchronize()
+    array_graph = as_array_graph(graph)
+    if validate:
+        from .validation import check_graph
+        check_graph(array_graph)
 
-    brain_nodes = gmsh.model.mesh.getNodes()[1].reshape((-1, 3))
+    # Surface is read directly, gmsh is only needed for the volume
+    triangles = read_stl(stl_path)
+    brain_nodes = np.unique(triangles.reshape((-1, 3)), axis=0)
     # We would like to align the brain ...
     com_brain, vals_brain, axis_brain = PCA_axis(brain_nodes)
     
-    nodes = graph.nodes
     # ... with the graph
-    graph_nodes = np.array([nodes[n]['pos'] for n in nodes])
+    graph_nodes = array_graph.pos.copy()
     com_graph, vals_graph, axis_graph = PCA_axis(graph_nodes)
 
     shift = com_brain - com_graph
@@ -149,11 +349,31 @@ def stl_embed(graph, stl_path, scale=0.8, view=False, args=[]):
 
     # Scale
     com_graph = np.mean(graph_nodes, axis=0)
-    graph_nodes[:] = graph_nodes*scale + (1-scale)*com_graph.reshape((1, -1))
+    if scale is None:
+        with instrument.stage('stl_fit', num_triangles=len(triangles), num_nodes=len(graph_nodes)) as event:
+            x = graph_nodes - com_graph.reshape((1, -1))
+            scale, center, clearance = fit_inside(x, TriangleBVH(triangles), com_graph, margin=margin,
+                                                  max_scale=max_scale, placement_steps=placement_steps)
+            event.update({'scale': float(scale), 'clearance': float(clearance)})
+        if scale == 0:
+            raise ValueError(f'Graph cannot be placed inside {stl_path} with margin {margin}')
+        graph_nodes[:] = center.reshape((1, -1)) + scale*x
+    else:
+        graph_nodes[:] = graph_nodes*scale + (1-scale)*com_graph.reshape((1, -1))
+
+    gmsh.initialize(args)
+
+    gmsh.merge(stl_path)
     
-    vertices = {n: fac.addPoint(*graph_nodes[i]) for i, n in enumerate(nodes)}
+    model = gmsh.model
+    fac = model.geo
+
+    vol = fac.addVolume([fac.addSurfaceLoop([1])])
+    fac.synchronize()
+
+    vertices = np.fromiter((fac.addPoint(*p) for p in graph_nodes.tolist()), dtype=np.int64, count=len(graph_nodes))
 
-    lines = [fac.addLine(vertices[p], vertices[q]) for p, q in graph.edges]
+    lines = [fac.addLine(p, q) for p, q in vertices[array_graph.edges].tolist()]
     fac.synchronize()
     # Mark them for lookup
     model.addPhysicalGroup(1, lines, 1)
@@ -168,6 +388,11 @@ def stl_embed(graph, stl_path, scale=0.8, view=False, args=[]):
         gmsh.fltk.run()
     gmsh.finalize()
 
+    if not isinstance(graph, nx.Graph):
+        return ArrayGraph(graph_nodes, array_graph.edges, scale*array_graph.radius, array_graph.ntype,
+                          labels=array_graph.labels)
+
+    nodes = graph.nodes
     for i, n in enumerate(nodes):
         nodes[n]['pos'] = graph_nodes[i]
 
@@ -0,0 +1,240 @@
+# Graph mesh with all its data in one HDF5 file (+ XDMF sidecar for ParaView)
+#
+# /mesh/coordinates, /mesh/cells
+# /cell_data/<name>, /vertex_data/<name>
+# /branches/{colors, ends, cell_offsets, cells, vertex_offsets, vertices}
+# /orientation/{colors, vertices, cells, markers}
+import numpy as np
+import h5py
+import os
+
+
+def _data_array(f, mesh_size):
+    '''Array and its kind ('cell' or 'vertex') of MeshFunction, Function or array'''
+    # MeshFunction
+    if hasattr(f, 'array') and hasattr(f, 'dim'):
+        return f.array(), ('cell' if f.dim() == 1 else 'vertex')
+    # Function
+    if hasattr(f, 'function_space'):
+        from .operators import cell_values
+
+        if f.function_space().ufl_element().degree() == 0:
+            return cell_values(f), 'cell'
+        values = f.compute_vertex_values()
+        nvertices = f.function_space().mesh().num_vertices()
+        # Components are stacked
+        return values.reshape((-1, nvertices)).T.squeeze(), 'vertex'
+
+    f = np.asarray(f)
+    nvertices, ncells = mesh_size
+    assert len(f) in (nvertices, ncells)
+    return f, ('cell' if len(f) == ncells else 'vertex')
+
+
+def write_graph_h5(path, mesh, data=None, traversal=None, color_connectivity=None, orientation=None,
+                   compression='gzip', compression_opts=4, chunk_size=2**16, xdmf=True):
+    '''
+    Write graph mesh (dolfin mesh or (coordinates, cells)) with data {name:
+    MeshFunction/DG0 or CG1 Function/array} (cell or vertex data; arrays
+    are cell data if their length is the number of cells), branch
+    decomposition (BranchTraversal and/or color_connectivity) and orientation
+    (output of endpoint_orientation) to one HDF5 file. Datasets are chunked
+    and compressed; with compression=None they are contiguous so the reader
+    can memory map them. Optionally also XDMF sidecar for visualization.
+    '''
+    x, cells = (mesh.coordinates(), mesh.cells()) if hasattr(mesh, 'coordinates') else mesh
+    x, cells = np.asarray(x), np.asarray(cells)
+    mesh_size = (len(x), len(cells))
+
+    def dataset(group, name, array):
+        array = np.asarray(array)
+        options = {}
+        if compression is not None and array.size:
+            # Chunks along the first axis
+            options = {'compression': compression,
+                       'compression_opts': compression_opts,
+                       'chunks': (min(len(array), chunk_size), ) + array.shape[1:]}
+        return group.create_dataset(name, data=array, **options)
+
+    with h5py.File(path, 'w') as out:
+        out.attrs['num_vertices'], out.attrs['num_cells'] = mesh_size
+        out.attrs['gdim'] = x.shape[1]
+
+        group = out.create_group('mesh')
+        dataset(group, 'coordinates', x)
+        dataset(group, 'cells', cells)
+
+        groups = {'cell': out.create_group('cell_data'), 'vertex': out.create_group('vertex_data')}
+        for name, f in (data or {}).items():
+            array, kind = _data_array(f, mesh_size)
+            dataset(groups[kind], name, array)
+
+        if traversal is not None or color_connectivity is not None:
+            group = out.create_group('branches')
+            if traversal is not None:
+                for name in ('colors', 'cell_offsets', 'cells', 'vertex_offsets', 'vertices'):
+                    dataset(group, name, getattr(traversal, name))
+            if color_connectivity is not None:
+                colors = sorted(color_connectivity)
+                # Color, end, start
+                dataset(group, 'ends', np.array([(c, ) + tuple(color_connectivity[c]) for c in colors],
+                                                dtype=np.int64).reshape((-1, 3)))
+
+        if orientation is not None:
+            group = out.create_group('orientation')
+            for name, array in zip(('colors', 'vertices', 'cells', 'markers'), orientation):
+                dataset(group, name, array)
+
+        cell_names, vertex_names = list(groups['cell']), list(groups['vertex'])
+
+    if xdmf:
+        write_xdmf(path, mesh_size, x.shape[1], cell_names, vertex_names)
+
+    return path
+
+
+def write_xdmf(path, mesh_size, gdim, cell_names=(), vertex_names=(), xdmf_path=None):
+    '''XDMF file pointing to the mesh and data in HDF5 file'''
+    nvertices, ncells = mesh_size
+    h5_name = os.path.basename(path)
+    xdmf_path = xdmf_path or os.path.splitext(path)[0] + '.xdmf'
+
+    def item(dataset, dims, number_type='Float', precision=8):
+        dims = ' '.join(map(str, dims))
+        return (f'<DataItem Dimensions="{dims}" NumberType="{number_type}" Precision="{precision}" '
+                f'Format="HDF">{h5_name}:{dataset}</DataItem>')
+
+    with h5py.File(path, 'r') as h5:
+        def attribute(center, group, name):
+            array = h5[f'{group}/{name}']
+            kind = 'Scalar' if array.ndim == 1 else 'Vector'
+            number_type = 'Float' if array.dtype.kind == 'f' else ('UInt' if array.dtype.kind == 'u' else 'Int')
+            return (f'<Attribute Name="{name}" AttributeType="{kind}" Center="{center}">'
+                    f'{item(f"/{group}/{name}", array.shape, number_type, array.dtype.itemsize)}</Attribute>')
+
+        attributes = ([attribute('Cell', 'cell_data', name) for name in cell_names] +
+                      [attribute('Node', 'vertex_data', name) for name in vertex_names])
+        cells_dtype = h5['mesh/cells'].dtype
+
+    geometry = 'XYZ' if gdim == 3 else 'XY'
+    lines = ['<?xml version="1.0"?>',
+             '<Xdmf Version="3.0">',
+             '<Domain>',
+             '<Grid Name="graph" GridType="Uniform">',
+             f'<Topology TopologyType="Polyline" NodesPerElement="2" NumberOfElements="{ncells}">',
+             item('/mesh/cells', (ncells, 2), 'UInt' if cells_dtype.kind == 'u' else 'Int', cells_dtype.itemsize),
+             '</Topology>',
+             f'<Geometry GeometryType="{geometry}">',
+             item('/mesh/coordinates', (nvertices, gdim)),
+             '</Geometry>'] + attributes + ['</Grid>', '</Domain>', '</Xdmf>']
+
+    with open(xdmf_path, 'w') as out:
+        out.write('\n'.join(lines) + '\n')
+
+    return xdmf_path
+
+
+class GraphH5(object):
+    '''
+    Lazy reader of files from write_graph_h5. Arrays are h5py datasets
+    (read on slicing) or, if stored contiguous and uncompressed, memory
+    mapped numpy arrays. Use as context manager or close.
+    '''
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap = mmap
+        self.file = h5py.File(path, 'r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __getitem__(self, name):
+        '''View of dataset, e.g. 'mesh/coordinates' or 'cell_data/radius' '''
+        dataset = self.file[name]
+        if not self.mmap or dataset.chunks is not None or dataset.compression is not None:
+            return dataset
+
+        offset = dataset.id.get_offset()
+        # Empty datasets have no storage
+        if offset is None:
+            return dataset[()]
+        return np.memmap(self.path, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+    def __contains__(self, name):
+        return name in self.file
+
+    @property
+    def coordinates(self):
+        return self['mesh/coordinates']
+
+    @property
+    def cells(self):
+        return self['mesh/cells']
+
+    def cell_data(self):
+        '''Names of cell data'''
+        return list(self.file['cell_data'])
+
+    def vertex_data(self):
+        '''Names of vertex data'''
+        return list(self.file['vertex_data'])
+
+    def branch(self, color):
+        '''Ordered cells and vertices of branch, read without loading the rest'''
+        branches = self.file['branches']
+        colors = branches['colors'][()]
+        i, = np.where(colors == color)
+        assert len(i) == 1, f'No branch of color {color}'
+        i = i[0]
+
+        c0, c1 = branches['cell_offsets'][i:i+2]
+        v0, v1 = branches['vertex_offsets'][i:i+2]
+        return branches['cells'][c0:c1], branches['vertices'][v0:v1]
+
+    def orientation(self):
+        '''colors, vertices, cells and markers of the branch end points'''
+        group = self.file['orientation']
+        return tuple(group[name][()] for name in ('colors', 'vertices', 'cells', 'markers'))
+
+    def mesh(self):
+        '''Load as dolfin mesh'''
+        from .meshing import interval_mesh
+
+        return interval_mesh(self.coordinates[()], self.cells[()])
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from graph_mesh.generators import murray_tree
+    from graph_mesh.branching import decompose_branches, BranchTraversal
+    import tempfile
+    import time
+
+    graph = murray_tree(18, normal=None, seed=1, as_arrays=True)
+    colors, _, _, color_connectivity, _ = decompose_branches(graph.edges, graph.num_nodes)
+    traversal = BranchTraversal(graph.edges, colors)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for compression in ('gzip', None):
+            path = os.path.join(tmp, f'graph_{compression}.h5')
+
+            then = time.perf_counter()
+            write_graph_h5(path, (graph.pos, graph.edges), {'radius': graph.radius, 'ntype': graph.ntype,
+                                                            'colors': colors},
+                           traversal=traversal, color_connectivity=color_connectivity,
+                           compression=compression)
+            elapsed = time.perf_counter() - then
+
+            with GraphH5(path) as h5:
+                assert np.all(h5['cell_data/radius'][:100] == graph.radius[:100])
+                cells, vertices = h5.branch(colors[-1])
+                assert np.all(cells == traversal.branch_cells(colors[-1]))
+                kind = type(h5.coordinates).__name__
+
+            print(f'{compression} {os.path.getsize(path)/2**20:.1f}MB in {elapsed:.2f}s, coordinates as {kind}')
@@ -1,37 +1,163 @@
-import networkx as nx
+from .graph import ArrayGraph
 import dolfin as df
 import numpy as np
 
 
-def random_edge_graph(mesh, prob=0.5):
+def random_edge_graph(mesh, prob=0.5, seed=None, as_arrays=False):
     '''Graph based on the edge function'''
     assert mesh.topology().dim() > 1
-    
+
+    rng = np.random.default_rng(seed)
+
     edge_f = df.MeshFunction('size_t', mesh, 1, 0)
     num_edges = mesh.num_entities(1)
-    
-    edge_f.array()[np.random.rand(num_edges) > prob] = 1
+
+    edge_f.array()[rng.random(num_edges) > prob] = 1
 
     mesh.init(1, 0)
-    
-    G = nx.Graph()
-    radii = np.random.rand(sum(edge_f.array() == 1))
-    G.add_edges_from(tuple(e.entities(0)) + ({'radius': r}, )
-                      for e, r in zip(df.SubsetIterator(edge_f, 1), radii))
-    # Attach positions
-    x = mesh.coordinates()
+    e2v = mesh.topology()(1, 0)().reshape((-1, 2))
+    edges = e2v[edge_f.array() == 1]
+    # Only vertices of selected edges are nodes; their labels are vertex indices
+    vertices, edges = np.unique(edges, return_inverse=True)
+    edges = edges.reshape((-1, 2))
 
-    nodes = G.nodes
-    for i in nodes:
-        nodes[i]['pos'] = x[i]
+    graph = ArrayGraph(mesh.coordinates()[vertices], edges, radius=rng.random(len(edges)),
+                       labels=vertices)
 
-    return G, edge_f
+    return (graph if as_arrays else graph.to_networkx()), edge_f
 
 
-def random_unit_square(N, prob=0.5):
+def random_unit_square(N, prob=0.5, seed=None, as_arrays=False):
     '''Based on (0, 1)^2'''
     mesh = df.UnitSquareMesh(N, N)
 
-    return random_edge_graph(mesh, prob=prob)
+    return random_edge_graph(mesh, prob=prob, seed=seed, as_arrays=as_arrays)
+
+
+def random_lattice(n, dim=2, prob=0.5, seed=None, as_arrays=False):
+    '''
+    Random subgraph of the regular lattice with n cells in each direction of
+    (0, 1)^dim. Lattice edges are kept with probability 1-prob (as in
+    random_edge_graph) and isolated nodes are dropped. Radius is random.
+    '''
+    assert n > 0 and dim in (2, 3)
+
+    rng = np.random.default_rng(seed)
+
+    shape = (n+1, )*dim
+    index = np.arange((n+1)**dim).reshape(shape)
+    # Edges along each axis connect the index with its neighbor
+    edges = []
+    for axis in range(dim):
+        first = [slice(None)]*dim
+        first[axis] = slice(0, n)
+        second = [slice(None)]*dim
+        second[axis] = slice(1, n+1)
+        edges.append(np.column_stack([index[tuple(first)].ravel(), index[tuple(second)].ravel()]))
+    edges = np.vstack(edges)
+    edges = edges[rng.random(len(edges)) > prob]
+
+    vertices, edges = np.unique(edges, return_inverse=True)
+    edges = edges.reshape((-1, 2))
+    # Coordinates of the used vertices, x is the fastest varying
+    pos = np.column_stack(np.unravel_index(vertices, shape)[::-1])/n
+
+    graph = ArrayGraph(pos, edges, radius=rng.random(len(edges)), labels=vertices)
+
+    return graph if as_arrays else graph.to_networkx()
+
+
+def murray_tree(generations, gamma=0.8, lmbda=8, diameter=1., origin=(0, 0, 0), direction=(0, 1, 0),
+                normal=(0, 0, 1), seed=None, as_arrays=False):
+    '''
+    Bifurcating tree where daughter diameters satisfy Murray's law
+    D0**3 = D1**3 + D2**3 with D1 = gamma*D2, vessel length is lmbda*D and
+    bifurcation angles minimize the work (as in demo/alex_graph.py). With
+    normal the tree lies in the plane of that normal, otherwise each
+    bifurcation plane is random. Built one generation at a time so that
+    there are 2**generations - 1 edges.
+    '''
+    # By convention D1 <= D2
+    assert 0 < gamma <= 1
+    assert generations > 0
+
+    rng = np.random.default_rng(seed)
+
+    nnodes = 2**generations
+    pos = np.zeros((nnodes, 3))
+    # Edge i ends in node i+1
+    edges = np.zeros((nnodes-1, 2), dtype=np.int64)
+    diameters = np.zeros(nnodes-1)
+
+    direction = np.asarray(direction, dtype=float)
+    direction = direction/np.linalg.norm(direction)
+    if normal is not None:
+        normal = np.asarray(normal, dtype=float)
+        # Otherwise the bifurcation plane is not defined
+        assert np.linalg.norm(np.cross(normal/np.linalg.norm(normal), direction)) > 1E-8, 'normal || direction'
+
+    pos[0] = origin
+    pos[1] = pos[0] + lmbda*diameter*direction
+    edges[0] = (0, 1)
+    diameters[0] = diameter
+
+    # Murray's law and optimal angles
+    D2 = (gamma**3 + 1)**(-1/3)
+    D1 = gamma*D2
+    angles = [np.arccos((1 + D**4 - (1 - D**3)**(4/3))/(2*D**2)) for D in (D1, D2)]
+
+    # Parents are edges of the previous generation
+    parents = np.array([0])
+    for gen in range(1, generations):
+        nparents = len(parents)
+        start = pos[edges[parents, 0]]
+        end = pos[edges[parents, 1]]
+        tangent = (end - start)/np.linalg.norm(end - start, axis=1)[:, None]
+
+        if normal is None:
+            n = rng.standard_normal((nparents, 3))
+        else:
+            n = np.repeat(normal.reshape((1, 3)), nparents, axis=0)
+        # Rotation axis is perpendicular to the parent
+        n = n - np.sum(n*tangent, axis=1)[:, None]*tangent
+        n = n/np.linalg.norm(n, axis=1)[:, None]
+        # Which daughter goes left
+        sign = rng.choice((-1, 1), size=nparents)
+
+        first = 2**gen - 1
+        children = np.arange(first, first + 2*nparents).reshape((nparents, 2))
+        for k, (ratio, angle) in enumerate(zip((D1, D2), angles)):
+            theta = (sign if k == 0 else -sign)*angle
+            # Rodrigues rotation of parent tangent about the normal
+            t = tangent*np.cos(theta)[:, None] + np.cross(n, tangent)*np.sin(theta)[:, None]
+
+            edge = children[:, k]
+            diameters[edge] = ratio*diameters[parents]
+            edges[edge, 0] = edges[parents, 1]
+            edges[edge, 1] = edge + 1
+            pos[edge + 1] = end + lmbda*diameters[edge][:, None]*t
+        parents = children.ravel()
+
+    graph = ArrayGraph(pos, edges, radius=0.5*diameters)
+
+    return graph if as_arrays else graph.to_networkx()
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    import time
+
+    for generations in (16, 20, 23):
+        then = time.perf_counter()
+        graph = murray_tree(generations, normal=None, seed=1, as_arrays=True)
+        print(f'murray_tree {graph} {time.perf_counter()-then:.2f}s')
 
+    for n in (256, 1024, 2048):
+        then = time.perf_counter()
+        graph = random_lattice(n, dim=2, seed=1, as_arrays=True)
+        print(f'random_lattice {graph} {time.perf_counter()-then:.2f}s')
 
+    for n in (64, 128):
+        then = time.perf_counter()
+        graph = random_lattice(n, dim=3, seed=1, as_arrays=True)
+        print(f'random_lattice {graph} {time.perf_counter()-then:.2f}s')
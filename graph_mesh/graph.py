@@ -0,0 +1,108 @@
+import networkx as nx
+import numpy as np
+
+
+class ArrayGraph(object):
+    '''
+    Graph as contiguous arrays: node positions (nnodes x gdim), edges
+    (nedges x 2) in terms of node indices and per edge radius and ntype.
+    Labels are the original node ids (e.g. of networkx or SWC) if any.
+    '''
+    __slots__ = ('pos', 'edges', 'radius', 'ntype', 'labels')
+
+    def __init__(self, pos, edges, radius=None, ntype=None, labels=None):
+        self.pos = np.ascontiguousarray(pos, dtype=float)
+        assert self.pos.ndim == 2
+
+        self.edges = np.ascontiguousarray(np.asarray(edges).reshape((-1, 2)), dtype=np.int32)
+        assert not len(self.edges) or (0 <= np.min(self.edges) and np.max(self.edges) < len(self.pos))
+
+        nedges = len(self.edges)
+        # Not all generators tag the edges
+        self.radius = np.ascontiguousarray(np.ones(nedges) if radius is None else radius, dtype=float)
+        self.ntype = np.ascontiguousarray(np.zeros(nedges) if ntype is None else ntype, dtype=np.int64)
+        assert self.radius.shape == self.ntype.shape == (nedges, )
+
+        assert labels is None or len(labels) == len(self.pos)
+        self.labels = labels
+
+    @property
+    def num_nodes(self):
+        return len(self.pos)
+
+    @property
+    def num_edges(self):
+        return len(self.edges)
+
+    @property
+    def gdim(self):
+        return self.pos.shape[1]
+
+    def __len__(self):
+        # Like networkx
+        return self.num_nodes
+
+    def __repr__(self):
+        return f'ArrayGraph(num_nodes={self.num_nodes}, num_edges={self.num_edges}, gdim={self.gdim})'
+
+    @classmethod
+    def from_networkx(cls, graph):
+        '''Nodes have data `pos` and edges `radius` and (optional) `ntype`'''
+        nodes = graph.nodes
+        labels = list(nodes)
+        mapping = dict(zip(labels, range(len(labels))))
+
+        pos = np.array([nodes[n]['pos'] for n in labels], dtype=float).reshape((len(labels), -1))
+
+        nedges = graph.number_of_edges()
+        edges = np.fromiter((mapping[n] for e in graph.edges for n in e),
+                            dtype=np.int32, count=2*nedges).reshape((nedges, 2))
+
+        radius = np.fromiter((d['radius'] for _, _, d in graph.edges(data=True)),
+                             dtype=float, count=nedges)
+        ntype = np.fromiter((d.get('ntype', 0) for _, _, d in graph.edges(data=True)),
+                            dtype=np.int64, count=nedges)
+
+        return cls(pos, edges, radius, ntype, labels=labels)
+
+    @classmethod
+    def from_swc(cls, data):
+        '''From swc.SWCData; edges go from child to parent'''
+        from .swc import swc_edges
+
+        edges, radius, ntype = swc_edges(data)
+        return cls(data.pos, edges, radius, ntype, labels=data.index)
+
+    def to_networkx(self):
+        '''Graph with node data `pos` and edge data `radius`, `ntype`'''
+        if self.labels is None:
+            labels = np.arange(self.num_nodes)
+        else:
+            # Object array so that e.g. tuple node ids survive
+            labels = self.labels.tolist() if isinstance(self.labels, np.ndarray) else self.labels
+            labels = np.fromiter(labels, dtype=object, count=self.num_nodes)
+
+        G = nx.Graph()
+        G.add_nodes_from(zip(labels.tolist(), ({'pos': x} for x in self.pos)))
+        G.add_edges_from(zip(labels[self.edges[:, 0]].tolist(),
+                             labels[self.edges[:, 1]].tolist(),
+                             ({'radius': r, 'ntype': t}
+                              for r, t in zip(self.radius.tolist(), self.ntype.tolist()))))
+        return G
+
+    def copy(self):
+        return ArrayGraph(self.pos.copy(), self.edges.copy(), self.radius.copy(), self.ntype.copy(),
+                          labels=None if self.labels is None else self.labels.copy())
+
+
+def as_array_graph(graph):
+    '''ArrayGraph from networkx graph, SWCData or ArrayGraph (returned as is)'''
+    from .swc import SWCData
+
+    if isinstance(graph, ArrayGraph):
+        return graph
+
+    if isinstance(graph, SWCData):
+        return ArrayGraph.from_swc(graph)
+
+    return ArrayGraph.from_networkx(graph)
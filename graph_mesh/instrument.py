@@ -0,0 +1,150 @@
+from contextlib import contextmanager
+import tracemalloc
+import threading
+import functools
+import logging
+import json
+import time
+
+
+# Instrumentation is on iff there are sinks
+_sinks = []
+_trace_memory = False
+# Whether tracemalloc was started by enable (and so is stopped by disable)
+_started_tracing = False
+# Stack of peak memory seen by the currently running (nested) stages of the
+# main thread. Peaks of tracemalloc are process-wide so they are only
+# measured there and include allocations of other threads
+_peaks = []
+# Sinks are called from pool threads too
+_emit_lock = threading.Lock()
+
+
+class MemorySink(object):
+    '''Keep events in a list'''
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(event)
+
+
+class LoggerSink(object):
+    '''Send events to logger'''
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('graph_mesh')
+        self.level = level
+
+    def __call__(self, event):
+        self.logger.log(self.level, json.dumps(event, default=str))
+
+
+class JSONLinesSink(object):
+    '''Append events as JSON lines to file'''
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, event):
+        with open(self.path, 'a') as out:
+            out.write(json.dumps(event, default=str) + '\n')
+
+
+def enable(*sinks, memory=False):
+    '''
+    Turn on instrumentation with events sent to the sinks (callables). With
+    memory the peak of traced allocations (tracemalloc) is recorded too, for
+    the stages on the main thread only (the peak is process-wide).
+    '''
+    global _trace_memory, _started_tracing
+
+    assert sinks and all(callable(sink) for sink in sinks)
+    _sinks[:] = sinks
+
+    _trace_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+
+
+def disable():
+    '''Turn off instrumentation; tracing started by someone else is left on'''
+    global _trace_memory, _started_tracing
+
+    if _started_tracing and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _trace_memory, _started_tracing = False, False
+    _sinks.clear()
+
+
+def is_enabled():
+    return bool(_sinks)
+
+
+def emit(event):
+    '''Send event to all the sinks'''
+    with _emit_lock:
+        for sink in _sinks:
+            sink(event)
+
+
+@contextmanager
+def stage(name, **counts):
+    '''
+    Record wall time (and peak memory) of the block as event of the stage.
+    The yielded dict can be updated with counts. Does nothing if disabled.
+    Stages of other than the main thread get the thread name and no memory.
+    '''
+    if not _sinks:
+        yield {}
+        return
+
+    event = {'stage': name}
+    event.update(counts)
+
+    main_thread = threading.current_thread() is threading.main_thread()
+    if not main_thread:
+        event['thread'] = threading.current_thread().name
+    trace_memory = _trace_memory and main_thread
+
+    if trace_memory:
+        # Outer stage should still see the peak we are about to reset
+        start, peak = tracemalloc.get_traced_memory()
+        if _peaks:
+            _peaks[-1] = max(_peaks[-1], peak)
+        tracemalloc.reset_peak()
+        _peaks.append(0)
+
+    then = time.perf_counter()
+    try:
+        yield event
+    finally:
+        event['time'] = time.perf_counter() - then
+
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, _peaks.pop())
+            event['peak_memory'] = peak - start
+            if _peaks:
+                _peaks[-1] = max(_peaks[-1], peak)
+
+        emit(event)
+
+
+def instrumented(name, counts=None):
+    '''
+    Decorated function is recorded as stage. Counts is called with the
+    result to get a dict of counts for the event
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return f(*args, **kwargs)
+
+            with stage(name) as event:
+                result = f(*args, **kwargs)
+                if counts is not None:
+                    event.update(counts(result))
+            return result
+        return wrapper
+    return decorator
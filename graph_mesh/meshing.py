@@ -1,43 +1,174 @@
-from dolfin import MeshEditor, Mesh, Function, FunctionSpace
-import networkx as nx
+from dolfin import MeshEditor, Mesh, Function, FunctionSpace, compile_cpp_code
+from .instrument import instrumented
+from .graph import as_array_graph
+from .utils import dofmap_array
 import numpy as np
 
 
-def mesh_graph(graph):
-    '''1d mesh of graph. Assume nodes have data `pos` and edges have `radius`'''
-    nodes = graph.nodes
+# MeshEditor is driven from C++ so that there are no calls per vertex/cell
+_fill_interval_mesh_code = '''
+#include <pybind11/pybind11.h>
+#include <pybind11/eigen.h>
+#include <dolfin/geometry/Point.h>
+#include <dolfin/mesh/Mesh.h>
+#include <dolfin/mesh/MeshEditor.h>
+#include <dolfin/mesh/CellType.h>
+
+namespace py = pybind11;
+
+using Coordinates = Eigen::Matrix<double, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>;
+using Cells = Eigen::Matrix<std::size_t, Eigen::Dynamic, 2, Eigen::RowMajor>;
+
+void fill_interval_mesh(std::shared_ptr<dolfin::Mesh> mesh,
+                        const Eigen::Ref<const Coordinates> x,
+                        const Eigen::Ref<const Cells> cells)
+{
+  const std::size_t gdim = x.cols();
+
+  dolfin::MeshEditor editor;
+  editor.open(*mesh, dolfin::CellType::Type::interval, 1, gdim);
+
+  editor.init_vertices(x.rows());
+  for (std::size_t i = 0; i < (std::size_t)x.rows(); ++i)
+    editor.add_vertex(i, dolfin::Point(gdim, x.row(i).data()));
+
+  editor.init_cells(cells.rows());
+  for (std::size_t c = 0; c < (std::size_t)cells.rows(); ++c)
+    editor.add_cell(c, cells(c, 0), cells(c, 1));
+
+  editor.close();
+}
+
+PYBIND11_MODULE(SIGNATURE, m)
+{
+  m.def("fill_interval_mesh", &fill_interval_mesh);
+}
+'''
+
+_fill_interval_mesh = None
 
-    mesh_coordinates = np.row_stack([nodes[n]['pos'] for n in nodes])
-    nvtx, gdim = mesh_coordinates.shape
-    tdim = 1
 
-    mapping = dict((n, i) for i, n in enumerate(nodes))
-    
+@instrumented('mesh_graph', counts=lambda r: {'vertices': r[0].num_vertices(), 'cells': r[0].num_cells()})
+def mesh_graph_arrays(coordinates, edges, radius, ntype):
+    '''
+    1d mesh from vertex coordinates (nvtx x gdim) and edges as (nedges x 2)
+    array of vertex indices. Radius and ntype are per edge data which is
+    returned as DG0 functions.
+    '''
+    mesh = interval_mesh(coordinates, edges)
+    assert len(radius) == len(ntype) == mesh.num_cells()
+
+    return (mesh, ) + tuple(cell_data_function(mesh, data) for data in (radius, ntype))
+
+
+def interval_mesh(coordinates, cells):
+    '''Mesh of intervals given by vertex coordinates and cell to vertex array'''
+    global _fill_interval_mesh
+
+    coordinates = np.ascontiguousarray(coordinates, dtype=float)
+    nvtx, gdim = coordinates.shape
+    assert gdim > 1
+
+    cells = np.ascontiguousarray(cells, dtype=np.uintp)
+    ncells, _ = cells.shape
+    assert _ == 2
+    assert np.all(cells < nvtx)
+
+    if _fill_interval_mesh is None:
+        _fill_interval_mesh = compile_cpp_code(_fill_interval_mesh_code).fill_interval_mesh
+
     mesh = Mesh()
-    editor = MeshEditor()
-    editor.open(mesh, 'interval', tdim, gdim)            
+    _fill_interval_mesh(mesh, coordinates, cells)
+
+    return mesh
+
+
+def cell_data_function(mesh, cell_data):
+    '''DG0 function with values given by cell_data indexed by cells'''
+    V = FunctionSpace(mesh, 'DG', 0)
+    f = Function(V)
+
+    values = f.vector().get_local()
+    values[dofmap_array(V).ravel()] = cell_data
+    f.vector().set_local(values)
+
+    return f
+
+
+def graph_arrays(graph):
+    '''Coordinates, edges (in terms of vertex indices), radius and ntype of the graph'''
+    graph = as_array_graph(graph)
+
+    return graph.pos, graph.edges, graph.radius, graph.ntype
+
+
+def mesh_graph(graph):
+    '''
+    1d mesh of graph (networkx, ArrayGraph or SWCData). For networkx assume
+    nodes have data `pos` and edges have `radius`
+    '''
+    return mesh_graph_arrays(*graph_arrays(graph))
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    # Benchmark against building the mesh from python one entity at a time
+    from graph_mesh.generators import random_unit_square
+    import time
+
+    def mesh_graph_loop(graph):
+        '''Reference where MeshEditor is called from python'''
+        nodes = graph.nodes
+
+        mesh_coordinates = np.array([nodes[n]['pos'] for n in nodes])
+        nvtx, gdim = mesh_coordinates.shape
+
+        mapping = dict((n, i) for i, n in enumerate(nodes))
+
+        mesh = Mesh()
+        editor = MeshEditor()
+        editor.open(mesh, 'interval', 1, gdim)
+
+        editor.init_vertices(nvtx)
+        editor.init_cells(graph.number_of_edges())
+
+        for i, x in enumerate(mesh_coordinates):
+            editor.add_vertex(i, x)
+
+        radius_cell_data = np.zeros(graph.number_of_edges())
+        ntype_cell_data = np.zeros(graph.number_of_edges())
+
+        edges = graph.edges()
+        for ci, (ni, nj) in enumerate(edges):
+            editor.add_cell(ci, (mapping[ni], mapping[nj]))
+            radius_cell_data[ci] = edges[(ni, nj)]['radius']
+            ntype_cell_data[ci] = edges[(ni, nj)].get('ntype', 0)
+        editor.close()
+
+        radius_data = Function(FunctionSpace(mesh, 'DG', 0))
+        radius_data.vector().set_local(radius_cell_data)
+
+        ntype_data = Function(FunctionSpace(mesh, 'DG', 0))
+        ntype_data.vector().set_local(ntype_cell_data)
 
-    editor.init_vertices(nvtx)
-    editor.init_cells(graph.number_of_edges())
+        return mesh, radius_data, ntype_data
 
-    for i, x in enumerate(mesh_coordinates):
-        editor.add_vertex(i, x)
+    # Trigger JIT outside of timing
+    mesh_graph(random_unit_square(2)[0])
 
-    radius_cell_data = np.zeros(graph.number_of_edges())
-    ntype_cell_data = np.zeros(graph.number_of_edges())
+    for N in (64, 128, 256, 512):
+        G, _ = random_unit_square(N)
 
-    edges = graph.edges()
-    for ci, (ni, nj) in enumerate(edges):
-        editor.add_cell(ci, (mapping[ni], mapping[nj]))
-        radius_cell_data[ci] = edges[(ni, nj)]['radius']
-        ntype_cell_data[ci] = edges[(ni, nj)]['ntype']        
-    
-    editor.close()
+        then = time.perf_counter()
+        mesh0, r0, _ = mesh_graph_loop(G)
+        t_loop = time.perf_counter() - then
 
-    radius_data = Function(FunctionSpace(mesh, 'DG', 0))
-    radius_data.vector().set_local(radius_cell_data)
+        then = time.perf_counter()
+        mesh, r, _ = mesh_graph(G)
+        t_bulk = time.perf_counter() - then
 
-    ntype_data = Function(FunctionSpace(mesh, 'DG', 0))
-    ntype_data.vector().set_local(ntype_cell_data)
+        assert np.linalg.norm(mesh0.coordinates() - mesh.coordinates()) < 1E-13
+        assert np.all(mesh0.cells() == mesh.cells())
+        assert abs(r0.vector().norm('l2') - r.vector().norm('l2')) < 1E-10
 
-    return mesh, radius_data, ntype_data
+        print(f'#cells = {mesh.num_cells()} loop {t_loop:.3f}s bulk {t_bulk:.3f}s speedup {t_loop/t_bulk:.1f}')
@@ -0,0 +1,194 @@
+# Operators on 1d meshes (in gdim > 1) assembled from the arrays of the mesh
+# without UFL/FFC. P1 matrices are in the vertex numbering of the mesh (use
+# vertex_to_dof_map to compare with dolfin), P0 is numbered by cells.
+from .utils import dofmap_array
+import scipy.sparse as sp
+import numpy as np
+
+
+def mesh_arrays(mesh):
+    '''Vertex coordinates and cells of the mesh'''
+    assert mesh.topology().dim() == 1
+
+    return mesh.coordinates(), mesh.cells()
+
+
+def cell_values(f):
+    '''Values of DG0 (scalar or vector) function in cells of its mesh'''
+    V = f.function_space()
+    assert V.ufl_element().degree() == 0
+
+    values = f.vector().get_local()[dofmap_array(V)]
+    return values[:, 0] if values.shape[1] == 1 else values
+
+
+def cell_geometry(x, cells):
+    '''Length and unit tangent (from first to second vertex) of cells'''
+    d = x[cells[:, 1]] - x[cells[:, 0]]
+    h = np.linalg.norm(d, axis=1)
+
+    return h, d/h[:, None]
+
+
+def _assemble(rows, cols, local, shape):
+    '''Sparse matrix from (ncells x nrows x ncols) element matrices'''
+    nrows, ncols = local.shape[1:]
+    rows = np.repeat(rows.reshape((-1, nrows)), ncols, axis=1)
+    cols = np.tile(cols.reshape((-1, ncols)), (1, nrows))
+    # Coo sums the duplicates
+    return sp.csr_matrix((local.ravel(), (rows.ravel(), cols.ravel())), shape=shape)
+
+
+def _weight(weight, ncells):
+    return np.ones(ncells) if weight is None else np.asarray(weight, dtype=float)
+
+
+def mass_matrix(x, cells, weight=None):
+    '''P1 mass matrix with (cell constant) weight'''
+    h, _ = cell_geometry(x, cells)
+    w = _weight(weight, len(cells))*h/6
+
+    local = np.array([[2., 1.], [1., 2.]])[None]*w[:, None, None]
+    return _assemble(cells, cells, local, (len(x), len(x)))
+
+
+def area_mass_matrix(x, cells, radius):
+    '''P1 mass matrix weighted by the cross section area pi*r**2'''
+    return mass_matrix(x, cells, weight=np.pi*np.asarray(radius)**2)
+
+
+def stiffness_matrix(x, cells, weight=None):
+    '''P1 stiffness matrix, i.e. of inner(du/ds, dv/ds)*weight'''
+    h, _ = cell_geometry(x, cells)
+    w = _weight(weight, len(cells))/h
+
+    local = np.array([[1., -1.], [-1., 1.]])[None]*w[:, None, None]
+    return _assemble(cells, cells, local, (len(x), len(x)))
+
+
+def _tangent_sign(x, cells, tau):
+    '''Orientation of cells w.r.t tangent field (cell values), 1 without tau'''
+    if tau is None:
+        return np.ones(len(cells))
+    _, t = cell_geometry(x, cells)
+    return np.sum(t*np.asarray(tau), axis=1)
+
+
+def derivative_matrix(x, cells, tau=None, weight=None):
+    '''
+    P1 x P1 matrix of inner(dot(grad(u), tau), v)*weight where tau is the
+    DG0 tangent (as ncells x gdim array; cell orientation without it).
+    Rows are test functions.
+    '''
+    s = _weight(weight, len(cells))*_tangent_sign(x, cells, tau)
+    # du/ds = (u1 - u0)/h and each of v integrates to h/2
+    local = np.array([[-0.5, 0.5], [-0.5, 0.5]])[None]*s[:, None, None]
+    return _assemble(cells, cells, local, (len(x), len(x)))
+
+
+def mixed_mass_matrix(x, cells, weight=None):
+    '''P0 x P1 matrix of inner(u, q)*weight; rows are P0 test functions'''
+    h, _ = cell_geometry(x, cells)
+    w = _weight(weight, len(cells))*h/2
+
+    local = np.array([[1., 1.]])[None]*w[:, None, None]
+    return _assemble(np.arange(len(cells)), cells, local, (len(cells), len(x)))
+
+
+def mixed_derivative_matrix(x, cells, tau=None, weight=None):
+    '''P0 x P1 matrix of inner(dot(grad(u), tau), q)*weight'''
+    s = _weight(weight, len(cells))*_tangent_sign(x, cells, tau)
+
+    local = np.array([[-1., 1.]])[None]*s[:, None, None]
+    return _assemble(np.arange(len(cells)), cells, local, (len(cells), len(x)))
+
+
+def p0_mass_matrix(x, cells, weight=None):
+    '''Diagonal P0 mass matrix'''
+    h, _ = cell_geometry(x, cells)
+    return sp.diags(_weight(weight, len(cells))*h, format='csr')
+
+
+def branch_operator(operator, x, cells, cell_colors, color, compress=True, **kwargs):
+    '''
+    Operator on the cells of branch color. Cell data among kwargs (arrays
+    with value per cell) is restricted too. With compress the P1 space is
+    that of the branch vertices (returned as the second value; the order
+    is increasing), otherwise the operator is in the full numbering with
+    zeros outside. P0 rows are the branch cells.
+    '''
+    branch_cells, = np.where(np.asarray(cell_colors) == color)
+    ncells = len(cells)
+    kwargs = {key: (np.asarray(value)[branch_cells]
+                    if value is not None and np.ndim(value) and len(value) == ncells else value)
+              for key, value in kwargs.items()}
+
+    local_cells = cells[branch_cells]
+    if not compress:
+        return operator(x, local_cells, **kwargs), np.arange(len(x))
+
+    vertices, local_cells = np.unique(local_cells, return_inverse=True)
+    return operator(x[vertices], local_cells.reshape((-1, 2)), **kwargs), vertices
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    # Check against dolfin
+    from graph_mesh.generators import random_lattice, murray_tree
+    from graph_mesh.branching import color_branches
+    from graph_mesh import mesh_graph
+    import dolfin as df
+
+    def to_scipy(A):
+        indptr, indices, data = df.as_backend_type(A).mat().getValuesCSR()
+        return sp.csr_matrix((data, indices, indptr), shape=(A.size(0), A.size(1)))
+
+    def error(A, B):
+        return abs(A - B).max()/max(abs(B).max(), 1)
+
+    for graph in (random_lattice(16, dim=3, seed=1, as_arrays=True),
+                  murray_tree(6, normal=None, seed=1, as_arrays=True)):
+        mesh, radius_f, _ = mesh_graph(graph)
+        x, cells = mesh_arrays(mesh)
+        radius = cell_values(radius_f)
+
+        _, t = cell_geometry(x, cells)
+        # Some tangent field (flipped in some cells)
+        T = df.VectorFunctionSpace(mesh, 'DG', 0)
+        tau = df.Function(T)
+        values = tau.vector().get_local()
+        values[dofmap_array(T)] = t*np.where(np.arange(len(cells)) % 3, 1, -1)[:, None]
+        tau.vector().set_local(values)
+        tau_values = cell_values(tau)
+
+        V = df.FunctionSpace(mesh, 'CG', 1)
+        Q = df.FunctionSpace(mesh, 'DG', 0)
+        u, v = df.TrialFunction(V), df.TestFunction(V)
+        q = df.TestFunction(Q)
+        # Vertex numbering to dofs
+        P = sp.csr_matrix((np.ones(len(x)), (df.vertex_to_dof_map(V), np.arange(len(x)))))
+        # Cells to P0 dofs
+        R = sp.csr_matrix((np.ones(len(cells)), (dofmap_array(Q).ravel(), np.arange(len(cells)))))
+        Dt = lambda f: df.dot(df.grad(f), tau)
+
+        checks = {
+            'mass': (mass_matrix(x, cells), u*v*df.dx, P, P),
+            'stiffness': (stiffness_matrix(x, cells), df.inner(df.grad(u), df.grad(v))*df.dx, P, P),
+            'area_mass': (area_mass_matrix(x, cells, radius), df.pi*radius_f**2*u*v*df.dx, P, P),
+            'derivative': (derivative_matrix(x, cells, tau_values), Dt(u)*v*df.dx, P, P),
+            'mixed_mass': (mixed_mass_matrix(x, cells), u*q*df.dx, R, P),
+            'mixed_derivative': (mixed_derivative_matrix(x, cells, tau_values), Dt(u)*q*df.dx, R, P)
+        }
+        for name, (A, form, Prow, Pcol) in checks.items():
+            e = error(Prow @ A @ Pcol.T, to_scipy(df.assemble(form)))
+            print(f'{name} {e:.2E}')
+            assert e < 1E-12
+
+        # Branch restricted
+        cell_f, branch_colors, _, _ = color_branches(mesh)
+        dx_ = df.Measure('dx', domain=mesh, subdomain_data=cell_f)
+        color = branch_colors[0]
+        A, _ = branch_operator(area_mass_matrix, x, cells, cell_f.array(), color, compress=False, radius=radius)
+        e = error(P @ A @ P.T, to_scipy(df.assemble(df.pi*radius_f**2*u*v*dx_(color))))
+        print(f'branch area_mass {e:.2E}')
+        assert e < 1E-12
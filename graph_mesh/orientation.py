@@ -1,11 +1,50 @@
 from xii import EmbeddedMesh
 from xii.meshing.embedded_mesh import TangentCurve
+from .instrument import instrumented
+from .registry import BranchSubmeshRegistry
+from .utils import dofmap_array
 import numpy as np
 from dolfin import *
 from xii import *
 
 
-def compute_io_orientation(color_f, tau):
+def endpoint_orientation(color_f, tau):
+    '''
+    Let color_f be a cell function of a 1d in (dim > 1) mesh marking the
+    branches and tau a DG0 tangent field. For every end vertex of every
+    branch we compute marker 1 if dot(tau, n) > 0 where n is the outward
+    normal of the branch and 2 otherwise. No submeshes are built.
+
+    Return arrays of colors, vertices, cells and markers of the endpoints
+    '''
+    mesh = color_f.mesh()
+    assert mesh.id() == tau.function_space().mesh().id()
+    assert tau.function_space().ufl_element().degree() == 0
+
+    cells = mesh.cells()
+    colors = color_f.array()
+    x = mesh.coordinates()
+    # Tangent in each cell
+    tau_values = tau.vector().get_local()[dofmap_array(tau.function_space())]
+
+    # Endpoint is a vertex connected to only one cell of the color
+    pair_colors, pair_vertices = np.repeat(colors, 2), cells.ravel()
+    _, index, counts = np.unique(np.column_stack([pair_colors, pair_vertices]), axis=0,
+                                 return_index=True, return_counts=True)
+    index = index[counts == 1]
+
+    end_cells = index // 2
+    end_vertices = pair_vertices[index]
+    other_vertices = cells[end_cells, 1 - index % 2]
+    # Outward normal at the endpoint
+    n = x[end_vertices] - x[other_vertices]
+    markers = np.where(np.sum(tau_values[end_cells]*n, axis=1) > 0, 1, 2)
+
+    return pair_colors[index], end_vertices, end_cells, markers
+
+
+@instrumented('compute_io_orientation', counts=lambda r: {'branches': len(r)})
+def compute_io_orientation(color_f, tau, mode='batched', registry=None):
     '''
     Let color_f be a cell function of a 1d in (dim > 1) mesh marking the 
     branches. Using a mesh global tangent field tau we compute facet functions
@@ -13,7 +52,18 @@ def compute_io_orientation(color_f, tau):
     and 2 otherwise. 
 
     Return {color -> (oriented facet function (vertex functio), P1)}
+
+    In the batched mode the markers come from `endpoint_orientation` and the
+    branch tangent is restricted by cell maps, i.e. there is no assembly.
+    With mode='assemble' they are computed from forms on each branch.
+    Branch submeshes are taken from the registry; without it they live only
+    for this call.
     '''
+    assert mode in ('batched', 'assemble')
+    registry = registry if registry is not None else BranchSubmeshRegistry()
+    if mode == 'batched':
+        return batched_io_orientation(color_f, tau, registry)
+
     # NOTE: computed tangent orientation does not necessarily coincide with
     # fenics only so fenics tangential derivative should probably be replaced by
     # dot(grad(f), tau)
@@ -22,9 +72,9 @@ def compute_io_orientation(color_f, tau):
     # What we want to build
     oriented = {}
 
-    branch_colors = np.unique(color_f.array())
-    for color in branch_colors:
-        branch = EmbeddedMesh(color_f, color)  # This should be MeshView in FEniCS?
+    branches = registry.branches(color_f)
+    for color, (branch, _, _) in branches.items():
+        # NOTE: EmbeddedMesh should be MeshView in FEniCS?
         dx_ = Measure('dx', domain=branch)
         
         # Localize tangent
@@ -57,6 +107,35 @@ def compute_io_orientation(color_f, tau):
 
     return oriented
 
+
+def batched_io_orientation(color_f, tau, registry=None, colors=None):
+    '''compute_io_orientation with markers from endpoint_orientation (of colors)'''
+    registry = registry if registry is not None else BranchSubmeshRegistry()
+    end_colors, end_vertices, _, end_markers = endpoint_orientation(color_f, tau)
+    tau_values = tau.vector().get_local()[dofmap_array(tau.function_space())]
+    # Group endpoints by colors
+    ends = {}
+    for color, vertex, marker in zip(end_colors.tolist(), end_vertices.tolist(), end_markers.tolist()):
+        ends.setdefault(color, []).append((vertex, marker))
+
+    oriented = {}
+    for color, (branch, vertex_map, cell_map) in registry.branches(color_f, colors).items():
+        # Restrict the tangent
+        V = VectorFunctionSpace(branch, 'DG', 0)
+        tau_branch = Function(V)
+        values = tau_branch.vector().get_local()
+        values[dofmap_array(V)] = tau_values[cell_map]
+        tau_branch.vector().set_local(values)
+        # Mark endpoints
+        facet_f = MeshFunction('size_t', branch, 0, 0)
+        for vertex, marker in ends.get(color, []):
+            facet_f.array()[vertex_map == vertex] = marker
+
+        oriented[color] = (facet_f, branch, tau_branch)
+
+    return oriented
+
+
 # --------------------------------------------------------------------
 
 if __name__ == '__main__':
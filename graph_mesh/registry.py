@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from xii import EmbeddedMesh
+import numpy as np
+import hashlib
+
+
+def branch_entity_maps(branch, mesh):
+    '''Child to parent vertex and cell maps of embedded branch mesh as arrays'''
+    mapping = branch.parent_entity_map[mesh.id()]
+    tdim = branch.topology().dim()
+
+    return tuple(np.fromiter((mapping[dim][i] for i in range(branch.num_entities(dim))),
+                             dtype=np.int64, count=branch.num_entities(dim))
+                 for dim in (0, tdim))
+
+
+def coloring_key(color_f):
+    '''Identify coloring by its mesh and the values'''
+    return (color_f.mesh().id(), hashlib.sha1(color_f.array().tobytes()).hexdigest())
+
+
+class BranchSubmeshRegistry(object):
+    '''
+    Branch submeshes (EmbeddedMesh) together with their child to parent
+    vertex and cell maps built once per (mesh, coloring, color). The least
+    recently used ones are evicted once their (estimated) memory exceeds
+    the budget in bytes.
+    '''
+    def __init__(self, memory_budget=None):
+        assert memory_budget is None or memory_budget > 0
+        self.memory_budget = memory_budget
+
+        self._entries = OrderedDict()
+        self.memory = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def branches(self, color_f, colors=None):
+        '''{color: (branch, vertex_map, cell_map)} for colors (all by default)'''
+        if colors is None:
+            colors = np.unique(color_f.array())
+        # Hash only once
+        key = coloring_key(color_f)
+
+        return {color: self._get(color_f, color, key) for color in colors}
+
+    def get(self, color_f, color):
+        '''Branch submesh, vertex and cell map of branch color'''
+        return self._get(color_f, color, coloring_key(color_f))
+
+    def _get(self, color_f, color, key):
+        key = key + (int(color), )
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+        self.misses += 1
+        branch = EmbeddedMesh(color_f, color)
+        entry = (branch, ) + branch_entity_maps(branch, color_f.mesh())
+
+        nbytes = sum(array.nbytes for array in (branch.coordinates(), branch.cells()) + entry[1:])
+        self._entries[key] = (entry, nbytes)
+        self.memory += nbytes
+        # Keep at least the one we return
+        while self.memory_budget is not None and self.memory > self.memory_budget and len(self._entries) > 1:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.memory -= evicted_nbytes
+            self.evictions += 1
+
+        return entry
+
+    def clear(self):
+        '''Drop all the submeshes (counters are kept)'''
+        self._entries.clear()
+        self.memory = 0
+
+    def stats(self):
+        '''Counters of the cache'''
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'memory': self.memory,
+                'memory_budget': self.memory_budget}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# To share between callers explicitly (registry=branch_registry); bounded so
+# that long running processes do not keep submeshes of every mesh seen
+branch_registry = BranchSubmeshRegistry(memory_budget=2**28)
@@ -0,0 +1,96 @@
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+from collections import namedtuple
+from .coloring import branch_adjacency
+import numpy as np
+import heapq
+
+
+# Bins are arrays of branch colors, ordered by decreasing cost (and colors
+# within bin too) so that pools start with the largest work
+BranchSchedule = namedtuple('BranchSchedule', ('bins', 'costs', 'cells', 'imbalance', 'strategy'))
+
+
+def branch_cells_count(color_f, colors):
+    '''Number of cells of each of the colors (color_f is cell function or array)'''
+    values = np.asarray(color_f.array() if hasattr(color_f, 'array') else color_f, dtype=np.int64)
+    return np.bincount(values, minlength=np.max(colors)+1 if len(colors) else 1)[colors]
+
+
+def contiguous_bins(costs, order, nbins):
+    '''Bin of each node so that bins are contiguous pieces of order'''
+    cumulative = np.cumsum(costs[order])
+    total = cumulative[-1] if len(cumulative) else 0.
+    # Node goes to the bin where its middle falls
+    middle = cumulative - 0.5*costs[order]
+    bins = np.empty(len(costs), dtype=np.int64)
+    bins[order] = np.minimum((middle*nbins/total).astype(np.int64) if total > 0 else 0, nbins-1)
+    return bins
+
+
+def lpt_bins(costs, nbins):
+    '''Longest processing time first: largest node goes to least loaded bin'''
+    heap = [(0., b) for b in range(nbins)]
+    bins = np.empty(len(costs), dtype=np.int64)
+    for node in np.argsort(-costs, kind='stable').tolist():
+        load, b = heapq.heappop(heap)
+        bins[node] = b
+        heapq.heappush(heap, (load + costs[node], b))
+    return bins
+
+
+def partition_branches(color_f, color_connectivity, nbins, cost=None, overhead=0., tolerance=0.1):
+    '''
+    Group branches (colors of color_connectivity, e.g. from color_branches)
+    into nbins bins balanced by estimated cost. Cost of branch is
+    cost(ncells) or overhead + ncells. Branches are ordered by reverse
+    Cuthill-McKee of the branch adjacency and cut into contiguous pieces
+    so that adjacent branches stay together. If this is worse than
+    (1+tolerance) times the makespan of LPT (no locality) we use LPT.
+
+    Returns BranchSchedule; e.g. pool.map(work, schedule.bins).
+    '''
+    assert nbins > 0
+
+    colors, adjacency = branch_adjacency(color_connectivity)
+    cells = branch_cells_count(color_f, colors)
+    costs = np.asarray(cost(cells) if cost is not None else overhead + cells, dtype=float)
+
+    order = reverse_cuthill_mckee(adjacency, symmetric_mode=True) if len(colors) else np.zeros(0, dtype=np.int64)
+    candidates = {'contiguous': contiguous_bins(costs, order, nbins),
+                  'lpt': lpt_bins(costs, nbins)}
+    makespan = {strategy: np.max(np.bincount(bins, weights=costs, minlength=nbins)) if len(bins) else 0.
+                for strategy, bins in candidates.items()}
+    strategy = 'contiguous' if makespan['contiguous'] <= (1 + tolerance)*makespan['lpt'] else 'lpt'
+    bins = candidates[strategy]
+
+    bin_costs = np.bincount(bins, weights=costs, minlength=nbins)
+    bin_cells = np.bincount(bins, weights=cells, minlength=nbins).astype(np.int64)
+
+    schedule = []
+    for b in np.argsort(-bin_costs, kind='stable').tolist():
+        members, = np.where(bins == b)
+        schedule.append(colors[members[np.argsort(-costs[members], kind='stable')]])
+
+    by_cost = np.argsort(-bin_costs, kind='stable')
+    mean = np.mean(bin_costs)
+    return BranchSchedule(bins=schedule,
+                          costs=bin_costs[by_cost],
+                          cells=bin_cells[by_cost],
+                          imbalance=np.max(bin_costs)/mean if mean > 0 else 1.,
+                          strategy=strategy)
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from graph_mesh.branching import decompose_branches
+    from graph_mesh.generators import murray_tree, random_lattice
+    from graph_mesh.simplify import resample_chains
+
+    # Resampled chains give branches of very different sizes
+    graph, _, _ = resample_chains(murray_tree(12, normal=None, seed=1, as_arrays=True), spacing=0.1)
+    for name, graph in (('tree', graph), ('lattice', random_lattice(128, seed=1, as_arrays=True))):
+        colors, _, _, color_connectivity, _ = decompose_branches(graph.edges, graph.num_nodes)
+        for nbins in (2, 8, 32):
+            schedule = partition_branches(colors, color_connectivity, nbins, overhead=10)
+            print(f'{name} {len(color_connectivity)} branches into {nbins} bins ({schedule.strategy}) '
+                  f'imbalance {schedule.imbalance:.3f}')
@@ -0,0 +1,119 @@
+from .branching import BranchTraversal, _decompose_chains
+from .graph import ArrayGraph, as_array_graph
+from .instrument import instrumented
+import numpy as np
+
+
+@instrumented('resample_chains', counts=lambda r: {'nodes': r[0].num_nodes, 'edges': r[0].num_edges})
+def resample_chains(graph, spacing=None, relative=False):
+    '''
+    Replace chains of degree 2 nodes between terminals (nodes of other
+    degree) by polylines with segments of length about spacing. With
+    relative the spacing is in units of the local radius. Without spacing
+    each chain becomes a single segment (loops and parallel chains keep
+    enough segments to stay simple). Radius of new segment is the length
+    weighted mean of original edges (assigned by their midpoint) and ntype
+    is that of the edge at the segment midpoint.
+
+    Returns ArrayGraph, the original edge of each new edge (at its midpoint)
+    and the new edge of each original edge (containing its midpoint); the
+    latter is the lossless map, e.g. np.bincount(segment_of_edge, weights=...)
+    aggregates edge fields to the new edges (when refining, some new edges
+    contain no original midpoint).
+    '''
+    graph = as_array_graph(graph)
+    x, edges = graph.pos, graph.edges.astype(np.int64)
+    assert spacing is None or spacing > 0
+
+    colors, _, _, _, _ = _decompose_chains(edges, graph.num_nodes)
+    chains = BranchTraversal(edges, colors)
+    nchains = len(chains)
+
+    cells, vertices = chains.cells, chains.vertices
+    cell_offsets, vertex_offsets = chains.cell_offsets, chains.vertex_offsets
+    chain_of_cell = np.repeat(np.arange(nchains), np.diff(cell_offsets))
+
+    lengths = np.linalg.norm(x[edges[:, 1]] - x[edges[:, 0]], axis=1)
+    # Resampling is uniform in the units of (local) spacing
+    if spacing is None:
+        units = lengths
+    else:
+        units = lengths/(spacing*graph.radius if relative else spacing)
+    units = units[cells]
+
+    # Arc length (in units) at the ordered vertices; chains follow each other
+    cumulative = np.r_[0, np.cumsum(units)]
+    chain_start = cumulative[cell_offsets[:-1]]
+    chain_units = cumulative[cell_offsets[1:]] - chain_start
+    vertex_units = np.empty(len(vertices))
+    is_first = np.zeros(len(vertices), dtype=bool)
+    is_first[vertex_offsets[:-1]] = True
+    vertex_units[is_first] = chain_start
+    vertex_units[~is_first] = cumulative[1:]
+
+    # Number of new segments of each chain
+    first, last = vertices[vertex_offsets[:-1]], vertices[vertex_offsets[1:]-1]
+    nsegments = np.ones(nchains, dtype=np.int64) if spacing is None else np.maximum(np.rint(chain_units), 1).astype(np.int64)
+    _, pair_ids, pair_counts = np.unique(np.sort(np.column_stack([first, last]), axis=1), axis=0,
+                                         return_inverse=True, return_counts=True)
+    nsegments[pair_counts[pair_ids.ravel()] > 1] = np.maximum(nsegments[pair_counts[pair_ids.ravel()] > 1], 2)
+    nsegments[first == last] = np.maximum(nsegments[first == last], 3)
+    nsegments = np.minimum(nsegments, np.diff(cell_offsets)) if spacing is None else nsegments
+
+    def locate(chain, targets):
+        '''Index of ordered vertex starting the cell containing targets and the offset in it'''
+        index = np.searchsorted(vertex_units, targets, side='right') - 1
+        index = np.clip(index, vertex_offsets[chain], vertex_offsets[chain+1]-2)
+        width = vertex_units[index+1] - vertex_units[index]
+        t = np.divide(targets - vertex_units[index], width, out=np.zeros_like(targets), where=width > 0)
+        return index, np.clip(t, 0, 1)
+
+    # Interior points of chains, fractions k/n of the chain's arc length
+    segment_offsets = np.r_[0, np.cumsum(nsegments)]
+    point_chain = np.repeat(np.arange(nchains), nsegments-1)
+    k = np.arange(len(point_chain)) - (segment_offsets[:-1] - np.arange(nchains))[point_chain] + 1
+    targets = chain_start[point_chain] + k*chain_units[point_chain]/nsegments[point_chain]
+    index, t = locate(point_chain, targets)
+    interior = (1-t)[:, None]*x[vertices[index]] + t[:, None]*x[vertices[index+1]]
+
+    # Terminals are kept (renumbered), interior points are appended
+    terminals, terminal_ids = np.unique(np.r_[first, last], return_inverse=True)
+    first_ids, last_ids = terminal_ids[:nchains], terminal_ids[nchains:]
+    interior_ids = len(terminals) + np.arange(len(interior))
+
+    # Segment i of chain c goes from point i-1 to point i where point -1 is
+    # first and point n-1 is last
+    segment_chain = np.repeat(np.arange(nchains), nsegments)
+    is_chain_first = np.zeros(len(segment_chain), dtype=bool)
+    is_chain_first[segment_offsets[:-1]] = True
+    is_chain_last = np.zeros(len(segment_chain), dtype=bool)
+    is_chain_last[segment_offsets[1:]-1] = True
+
+    new_edges = np.empty((len(segment_chain), 2), dtype=np.int64)
+    new_edges[is_chain_first, 0] = first_ids
+    new_edges[~is_chain_first, 0] = interior_ids
+    new_edges[is_chain_last, 1] = last_ids
+    new_edges[~is_chain_last, 1] = interior_ids
+
+    # Original edge at midpoint of new segments
+    segment_k = np.arange(len(segment_chain)) - segment_offsets[segment_chain]
+    mid_targets = chain_start[segment_chain] + (segment_k+0.5)*chain_units[segment_chain]/nsegments[segment_chain]
+    index, _ = locate(segment_chain, mid_targets)
+    parent = cells[index - segment_chain]
+
+    # Original edges go to the new segment containing their midpoint
+    cell_mid = 0.5*(cumulative[:-1] + cumulative[1:]) - chain_start[chain_of_cell]
+    cell_segment = np.floor(cell_mid*nsegments[chain_of_cell]/np.where(chain_units > 0, chain_units, 1)[chain_of_cell])
+    cell_segment = segment_offsets[chain_of_cell] + np.clip(cell_segment.astype(np.int64), 0, nsegments[chain_of_cell]-1)
+
+    weight = lengths[cells]
+    total = np.bincount(cell_segment, weights=weight, minlength=len(segment_chain))
+    radius = np.bincount(cell_segment, weights=weight*graph.radius[cells], minlength=len(segment_chain))
+    radius = np.where(total > 0, radius/np.where(total > 0, total, 1), graph.radius[parent])
+
+    coarse = ArrayGraph(np.vstack([x[terminals], interior]), new_edges, radius, graph.ntype[parent])
+
+    segment_of_edge = np.empty(len(edges), dtype=np.int64)
+    segment_of_edge[cells] = cell_segment
+
+    return coarse, parent, segment_of_edge
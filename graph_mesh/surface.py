@@ -0,0 +1,415 @@
+from scipy.spatial import cKDTree
+import numpy as np
+
+
+def read_stl(path):
+    '''Triangles (ntriangles x 3 x 3) of binary or ASCII STL file'''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    # Binary is header (80), count (4) and 50 bytes per triangle
+    if len(data) >= 84:
+        count = int(np.frombuffer(data, dtype='<u4', count=1, offset=80)[0])
+        if 84 + 50*count == len(data):
+            record = np.dtype([('normal', '<f4', (3, )), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+            return np.frombuffer(data, dtype=record, count=count, offset=84)['vertices'].astype(float)
+
+    lines = data.decode(errors='replace').splitlines()
+    vertices = [line.split()[1:4] for line in lines if line.strip().startswith('vertex')]
+    return np.array(vertices, dtype=float).reshape((-1, 3, 3))
+
+
+def point_triangle_distances(p, triangles):
+    '''Distance from points p[i] to triangles[i] (Ericson, Real-Time Collision Detection)'''
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    dot = lambda u, v: np.sum(u*v, axis=1)
+
+    ab, ac, ap, bp, cp = b - a, c - a, p - a, p - b, p - c
+    d1, d2 = dot(ab, ap), dot(ac, ap)
+    d3, d4 = dot(ab, bp), dot(ac, bp)
+    d5, d6 = dot(ab, cp), dot(ac, cp)
+    va, vb, vc = d3*d6 - d5*d4, d5*d2 - d1*d6, d1*d4 - d3*d2
+
+    def divide(num, den):
+        return (np.divide(num, den, out=np.zeros_like(num), where=den != 0))[:, None]
+
+    denom = va + vb + vc
+    # Voronoi regions of the triangle in the order of the book's early returns
+    regions = [(d1 <= 0) & (d2 <= 0),
+               (d3 >= 0) & (d4 <= d3),
+               (vc <= 0) & (d1 >= 0) & (d3 <= 0),
+               (d6 >= 0) & (d5 <= d6),
+               (vb <= 0) & (d2 >= 0) & (d6 <= 0),
+               (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)]
+    closest = [a,
+               b,
+               a + divide(d1, d1 - d3)*ab,
+               c,
+               a + divide(d2, d2 - d6)*ac,
+               b + divide(d4 - d3, (d4 - d3) + (d5 - d6))*(c - b)]
+    interior = a + divide(vb, denom)*ab + divide(vc, denom)*ac
+
+    q = np.select([region[:, None] for region in regions], closest, default=interior)
+    return np.linalg.norm(p - q, axis=1)
+
+
+def ray_triangle_hits(origins, direction, triangles, eps=1E-12, tol=1E-8):
+    '''
+    Does the ray from origins[i] in direction hit triangles[i]
+    (Moller-Trumbore) and is the hit within tol of triangle edge
+    '''
+    a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+    e1, e2 = b - a, c - a
+
+    h = np.cross(direction[None], e2)
+    det = np.sum(e1*h, axis=1)
+    ok = np.abs(det) > eps
+    inv = np.divide(1., det, out=np.zeros_like(det), where=ok)
+
+    s = origins - a
+    u = inv*np.sum(s*h, axis=1)
+    q = np.cross(s, e1)
+    v = inv*(q @ direction)
+    t = inv*np.sum(e2*q, axis=1)
+
+    hits = ok & (u >= 0) & (v >= 0) & (u + v <= 1) & (t > eps)
+    # Near misses count too as they might be hits
+    near = ok & (u >= -tol) & (v >= -tol) & (u + v <= 1 + tol) & (t > -tol)
+    edge = near & ((np.minimum(u, v) <= tol) | (u + v >= 1 - tol) | (t <= tol))
+    return hits, edge
+
+
+class TriangleBVH(object):
+    '''
+    Bounding volume hierarchy over triangles: triangles are sorted along
+    the Morton curve of their centroids, grouped in leaves of leaf_size and
+    a complete binary tree (heap layout) is built bottom up. Queries are
+    batched over points; the tree is walked level by level for all points
+    at once.
+    '''
+    __slots__ = ('triangles', 'leaf_size', 'nleaves', 'lo', 'hi', 'depth', '_centroid_tree')
+
+    # Rays are cast in directions which are unlikely to be aligned with faces
+    directions = np.array([[1., 0.5377, 0.2113], [-0.3119, 1., 0.6793], [0.4281, -0.7741, 1.]])
+
+    def __init__(self, triangles, leaf_size=8):
+        triangles = np.asarray(triangles, dtype=float)
+        assert triangles.ndim == 3 and triangles.shape[1:] == (3, 3)
+
+        centroids = np.mean(triangles, axis=1)
+        # Morton codes with 10 bits per axis
+        lo, hi = np.min(centroids, axis=0), np.max(centroids, axis=0)
+        grid = ((centroids - lo)/np.where(hi > lo, hi - lo, 1)*1023).astype(np.int64)
+        codes = np.zeros(len(triangles), dtype=np.int64)
+        for bit in range(10):
+            for axis in range(3):
+                codes |= ((grid[:, axis] >> bit) & 1) << (3*bit + axis)
+        order = np.argsort(codes, kind='stable')
+        self.triangles = triangles[order]
+        self._centroid_tree = cKDTree(centroids[order])
+        self.leaf_size = leaf_size
+
+        # Complete tree on power of 2 leaves; padding leaves are empty
+        nleaves = max(1, -(-len(triangles)//leaf_size))
+        self.depth = int(np.ceil(np.log2(nleaves)))
+        self.nleaves = 2**self.depth
+
+        tri_lo, tri_hi = np.min(self.triangles, axis=1), np.max(self.triangles, axis=1)
+        starts = np.arange(0, len(triangles), leaf_size)
+        leaf_lo = np.full((self.nleaves, 3), np.inf)
+        leaf_hi = np.full((self.nleaves, 3), -np.inf)
+        leaf_lo[:len(starts)] = np.minimum.reduceat(tri_lo, starts, axis=0)
+        leaf_hi[:len(starts)] = np.maximum.reduceat(tri_hi, starts, axis=0)
+
+        nnodes = 2*self.nleaves - 1
+        self.lo, self.hi = np.empty((nnodes, 3)), np.empty((nnodes, 3))
+        self.lo[self.nleaves-1:], self.hi[self.nleaves-1:] = leaf_lo, leaf_hi
+        for level in reversed(range(self.depth)):
+            nodes = np.arange(2**level - 1, 2**(level+1) - 1)
+            self.lo[nodes] = np.minimum(self.lo[2*nodes+1], self.lo[2*nodes+2])
+            self.hi[nodes] = np.maximum(self.hi[2*nodes+1], self.hi[2*nodes+2])
+
+    def _candidates(self, points, test):
+        '''(point, triangle) pairs from leaves where test(point indices, nodes) holds'''
+        pts = np.arange(len(points))
+        nodes = np.zeros(len(points), dtype=np.int64)
+        for level in range(self.depth + 1):
+            keep = test(pts, nodes)
+            pts, nodes = pts[keep], nodes[keep]
+            if level < self.depth:
+                pts = np.repeat(pts, 2)
+                nodes = (2*np.repeat(nodes, 2) + 1) + np.tile([0, 1], len(nodes))
+
+        # Leaves to triangles
+        leaves = nodes - (self.nleaves - 1)
+        first = leaves*self.leaf_size
+        counts = np.clip(len(self.triangles) - first, 0, self.leaf_size)
+        pts = np.repeat(pts, counts)
+        triangles = np.repeat(first, counts) + np.arange(len(pts)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        return pts, triangles
+
+    def _batches(self, points, batch_size):
+        for start in range(0, len(points), batch_size):
+            yield start, points[start:start+batch_size]
+
+    def crossings(self, points, direction, batch_size=2**12, tol=1E-8):
+        '''
+        Number of triangles hit by rays from points in direction and whether
+        some hit is (up to tol in barycentric coordinates) on a triangle edge
+        so that the count is unreliable
+        '''
+        points = np.asarray(points, dtype=float)
+        direction = direction/np.linalg.norm(direction)
+        with np.errstate(divide='ignore'):
+            inv = 1/direction
+
+        counts = np.zeros(len(points), dtype=np.int64)
+        ambiguous = np.zeros(len(points), dtype=bool)
+        for start, batch in self._batches(points, batch_size):
+            def test(pts, nodes):
+                # Slab test
+                p, lo, hi = batch[pts], self.lo[nodes], self.hi[nodes]
+                t1, t2 = (lo - p)*inv, (hi - p)*inv
+                near, far = np.minimum(t1, t2), np.maximum(t1, t2)
+                tmin = np.maximum(np.maximum(near[:, 0], near[:, 1]), np.maximum(near[:, 2], 0))
+                tmax = np.minimum(np.minimum(far[:, 0], far[:, 1]), far[:, 2])
+                return tmax >= tmin
+
+            pts, triangles = self._candidates(batch, test)
+            hits, edge = ray_triangle_hits(batch[pts], direction, self.triangles[triangles], tol=tol)
+            counts[start:start+len(batch)] = np.bincount(pts[hits], minlength=len(batch))
+            ambiguous[start:start+len(batch)] = np.bincount(pts[edge], minlength=len(batch)) > 0
+        return counts, ambiguous
+
+    def contains(self, points):
+        '''
+        Are points inside the (closed) surface; parity of ray crossings.
+        Points whose ray grazes an edge get rays in other directions and
+        the majority vote.
+        '''
+        points = np.asarray(points, dtype=float)
+        counts, ambiguous = self.crossings(points, self.directions[0])
+        inside = counts % 2 == 1
+
+        recast, = np.where(ambiguous)
+        if len(recast):
+            votes = inside[recast].astype(int)
+            for direction in self.directions[1:]:
+                votes += self.crossings(points[recast], direction)[0] % 2
+            inside[recast] = votes >= 2
+        return inside
+
+    def distance(self, points, upper=None, batch_size=2**12, chunk_size=2**20):
+        '''
+        Distance of points to the nearest triangle. With upper (per point or
+        scalar) the result is min(distance, upper) which is cheaper to get.
+        '''
+        points = np.asarray(points, dtype=float)
+        # Upper bound from the triangle with the nearest centroid
+        _, nearest = self._centroid_tree.query(points)
+        bound = point_triangle_distances(points, self.triangles[nearest])
+        if upper is not None:
+            bound = np.minimum(bound, upper)
+
+        distance = np.empty(len(points))
+        for start, batch in self._batches(points, batch_size):
+            best = bound[start:start+len(batch)].copy()
+
+            def test(pts, nodes):
+                p = batch[pts]
+                gap = np.maximum(np.maximum(self.lo[nodes] - p, p - self.hi[nodes]), 0)
+                return gap[:, 0]**2 + gap[:, 1]**2 + gap[:, 2]**2 <= best[pts]**2
+
+            pts, triangles = self._candidates(batch, test)
+            # Pairs in chunks to bound memory
+            for first in range(0, len(pts), chunk_size):
+                chunk = slice(first, first+chunk_size)
+                d = point_triangle_distances(batch[pts[chunk]], self.triangles[triangles[chunk]])
+                np.minimum.at(best, pts[chunk], d)
+            distance[start:start+len(batch)] = best
+        return distance
+
+    def signed_distance(self, points):
+        '''Distance to the surface, positive inside'''
+        return np.where(self.contains(points), 1, -1)*self.distance(points)
+
+
+def fit_inside(x, bvh, center, margin=0., max_scale=1., tol=1E-3, maxiter=100, placement_steps=3,
+               relaxation=1.6, max_queries=2**16):
+    '''
+    Largest scale s <= max_scale such that all center + s*x are inside the
+    surface with distance at least margin. Scale grows by conservative
+    advancement: distance of center + s*x[i] changes at most by |x[i]|*ds
+    so every point is safe on an interval around the current s and no
+    inside tests are needed once the center is inside. Steps are
+    over-relaxed (by relaxation) and taken back to the conservative one if
+    the safe intervals of the two scales do not overlap. Stops when the
+    step is below tol*s or after max_queries point distances; the scale
+    reached so far is kept then.
+
+    Only the probes, the convex hull vertices of x, are advanced and all
+    the points are checked once at the end; those too close become probes
+    and the scale is recomputed. Out of budget it is instead shrunk to
+    what is certified by the surface free balls around the center and the
+    points. The center is improved by a coordinate
+    search along the axes (step is halved when no move helps). Returns
+    scale, center and clearance (smallest distance); scale is 0 if no
+    center with clearance margin was found.
+    '''
+    from scipy.spatial import ConvexHull, QhullError
+
+    x = np.asarray(x, dtype=float)
+    try:
+        probes = ConvexHull(x).vertices
+    except QhullError:
+        probes = np.arange(len(x))
+    queries = 0
+
+    def safe_steps(c, y, speed, s, cap):
+        nonlocal queries
+        queries += len(y)
+        # Distances are only needed up to what gives step cap
+        slack = bvh.distance(c + s*y, upper=margin + cap*speed) - margin
+        return np.divide(slack, speed, out=np.full_like(slack, np.inf), where=speed > 0)
+
+    def advance(c, y):
+        # All points start at the center
+        slack = bvh.distance(c[None])[0] - margin
+        if slack < 0 or not bvh.contains(c[None])[0]:
+            return 0.
+
+        speed = np.linalg.norm(y, axis=1)
+        if np.max(speed) == 0:
+            return max_scale
+
+        s, h = 0., slack/np.max(speed)
+        for _ in range(maxiter):
+            # Every probe is safe up to s + h
+            if queries >= max_queries:
+                return min(s + h, max_scale)
+            step = min(relaxation*h, max_scale - s)
+            # Safe steps are clamped at cap >= step which keeps them conservative
+            cap = 2*relaxation*h
+            h_next = safe_steps(c, y, speed, s + step, cap)
+            if np.any(h_next < 0) or np.any(h + h_next < step):
+                step = min(h, max_scale - s)
+                h_next = safe_steps(c, y, speed, s + step, cap)
+            s, h = s + step, np.min(h_next)
+            if step <= tol*s:
+                break
+        return s
+
+    center = np.asarray(center, dtype=float)
+    scale = advance(center, x[probes])
+
+    step = 0.1*np.max(np.ptp(bvh.triangles.reshape((-1, 3)), axis=0))
+    for _ in range(placement_steps):
+        if scale >= max_scale or queries >= max_queries:
+            break
+        candidates = [(advance(center + shift, x[probes]), center + shift)
+                      for shift in np.vstack([np.eye(3), -np.eye(3)])*step]
+        best_scale, best_center = max(candidates, key=lambda c: c[0])
+        if best_scale > scale:
+            scale, center = best_scale, best_center
+        else:
+            step /= 2
+
+    if scale == 0:
+        return scale, center, bvh.signed_distance(center[None])[0]
+
+    def signed_distances(c, s):
+        # Capped at the distance of the probes which are safe (up to round
+        # off) by advancement
+        y = c + s*x
+        probe_distance = bvh.distance(y[probes])
+        distance = bvh.distance(y, upper=np.min(probe_distance))
+        # Balls around the center and the probes are free of the surface so
+        # only the points outside of them need the inside test
+        balls = np.vstack([c, y[probes]])
+        radii = np.r_[bvh.distance(c[None]), probe_distance]
+        gap, nearest = cKDTree(balls).query(y, k=min(8, len(balls)))
+        inside = np.any(gap.reshape((len(y), -1)) < radii[nearest.reshape((len(y), -1))], axis=1)
+        unknown, = np.where(~inside)
+        inside[unknown] = bvh.contains(y[unknown])
+        return np.where(inside, distance, -distance)
+
+    def shrink(c, s, clearance):
+        # Largest s' <= s where every point is in the ball around the center
+        # (s'|x| <= its slack) or, having clearance, in the ball around its
+        # position at s ((s - s')|x| <= clearance - margin)
+        speed = np.linalg.norm(x, axis=1)
+        moving = speed > 0
+        lower = np.divide(bvh.distance(c[None])[0] - margin, speed, out=np.full_like(speed, np.inf), where=moving)
+        upper = np.divide(clearance - margin, speed, out=np.full_like(speed, np.inf), where=moving)
+        upper = np.where(clearance >= margin, s - upper, np.inf)
+        while True:
+            violated = (lower < s) & (s < upper)
+            if not np.any(violated):
+                return s
+            s = np.min(lower[violated])
+
+    while True:
+        clearance = signed_distances(center, scale)
+        close = np.setdiff1d(np.where(clearance < margin)[0], probes)
+        if not len(close):
+            return scale, center, np.min(clearance)
+        probes = np.union1d(probes, close)
+        # Advancement with the new probes is verified in the next round
+        scale = max(shrink(center, scale, clearance), advance(center, x[probes]))
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    from scipy.spatial import ConvexHull, Delaunay
+    from graph_mesh.generators import murray_tree
+    import time
+
+    # Ellipsoid surface
+    rng = np.random.default_rng(1)
+    y = rng.standard_normal((20000, 3))
+    y = y/np.linalg.norm(y, axis=1)[:, None]*np.array([2., 1., 1.])
+    hull = ConvexHull(y)
+
+    then = time.perf_counter()
+    bvh = TriangleBVH(y[hull.simplices])
+    print(f'BVH of {len(hull.simplices)} triangles in {time.perf_counter()-then:.2f}s')
+
+    points = rng.uniform(-2.2, 2.2, (10000, 3))
+    then = time.perf_counter()
+    inside = bvh.contains(points)
+    print(f'Inside test of {len(points)} points in {time.perf_counter()-then:.2f}s')
+    assert np.all(inside == (Delaunay(y).find_simplex(points) >= 0))
+
+    then = time.perf_counter()
+    distance = bvh.distance(points[:200])
+    print(f'Distance of {len(distance)} points in {time.perf_counter()-then:.2f}s')
+    brute = [np.min(point_triangle_distances(np.tile(p, (len(bvh.triangles), 1)), bvh.triangles))
+             for p in points[:200]]
+    assert np.allclose(distance, brute)
+
+    for generations in (8, 13):
+        graph = murray_tree(generations, normal=None, seed=1, as_arrays=True)
+        x = graph.pos - np.mean(graph.pos, axis=0)
+        then = time.perf_counter()
+        scale, center, clearance = fit_inside(x, bvh, np.array([0.5, 0, 0]), margin=0.05, max_scale=10)
+        print(f'Fitted {len(x)} points with scale {scale:.3f} at {center} with clearance {clearance:.3f} '
+              f'in {time.perf_counter()-then:.2f}s')
+        assert np.all(bvh.contains(center + scale*x)) and clearance >= 0.05 - 1E-10
+
+    # Star shaped (concave) surface; running out of budget keeps a safe scale
+    u = rng.standard_normal((4000, 3))
+    u = u/np.linalg.norm(u, axis=1)[:, None]
+    r = 1 + 0.35*np.cos(5*np.arctan2(u[:, 1], u[:, 0]))*(1 - u[:, 2]**2)
+    star = TriangleBVH((u*r[:, None])[ConvexHull(u).simplices])
+
+    graph = murray_tree(8, normal=None, seed=1, as_arrays=True)
+    x = graph.pos - np.mean(graph.pos, axis=0)
+    scales = []
+    for max_queries in (2**16, 2**9):
+        scale, center, clearance = fit_inside(x, star, np.zeros(3), margin=0.02, max_scale=10,
+                                              max_queries=max_queries)
+        print(f'Star with {max_queries} queries: scale {scale:.4f} clearance {clearance:.4f}')
+        assert np.all(star.contains(center + scale*x)) and clearance >= 0.02 - 1E-10
+        scales.append(scale)
+    assert 0 < scales[1] <= scales[0]
@@ -1,32 +1,66 @@
+from collections import namedtuple
+from .instrument import instrumented
 import networkx as nx
 import numpy as np
-import itertools
 
 
-def swc2graph(swc_file):
-    '''Parse SWC file to valid graph for `graph-mesh`'''
-    parse = lambda l: [fi(li) for fi, li in zip((int, int, float, float, float, float, int), l)]
+# Columns of SWC file; pos is x, y, z stacked
+SWCData = namedtuple('SWCData', ('index', 'ntype', 'pos', 'radius', 'parent'))
+
+
+def read_swc(swc_file):
+    '''Load SWC file into contiguous arrays (one pass, vectorized checks)'''
     # 1 1 0.0 0.0 0.0 7.3875 -1
+    table = np.loadtxt(swc_file, comments='#', ndmin=2, dtype=float)
+    assert table.shape[1] == 7, f'Expected 7 columns in SWC file, got {table.shape[1]}'
+
+    index = table[:, 0].astype(np.int64)
+    ntype = table[:, 1].astype(np.int64)
+    parent = table[:, 6].astype(np.int64)
+    # Integer columns should really be integers
+    assert np.all(index == table[:, 0]) and np.all(parent == table[:, 6])
+    assert np.all(ntype == table[:, 1])
+    # SWC starts numbering at 1 and we want contiguous numbering
+    assert len(index) and np.all(index == np.arange(1, len(index)+1))
+    # Parent is a valid node or marks the root
+    assert np.all((parent == -1) | ((1 <= parent) & (parent <= len(index))))
+    assert np.all(parent != index)
+
+    return SWCData(index=index,
+                   ntype=ntype,
+                   pos=np.ascontiguousarray(table[:, 2:5]),
+                   radius=np.ascontiguousarray(table[:, 5]),
+                   parent=parent)
+
+
+def swc_edges(data):
+    '''
+    Edges (0-based vertex indices, child then parent) of SWC data together
+    with their radius and ntype which are those of the child
+    '''
+    # Roots are not connected to anything
+    child, = np.where(data.parent != -1)
+    edges = np.column_stack([child, data.parent[child]-1])
+
+    return edges, data.radius[child], data.ntype[child]
 
-    with open(swc_file, 'r') as swc:
-        comments = []
-        # Get comments out of the way
-        iter_points = map(lambda l: parse(l.strip().split()),
-                          # Talk about lambdas without side-effects :)
-                          itertools.dropwhile(lambda l: l.startswith('#') and comments.append(l) is None, swc))
-        # This is the first point - can't make pairs yet
-        index, ntype, x, y, z, radius, parent = next(iter_points)
-        # SWC starts numbering at 1
-        assert index == 1
 
-        G = nx.Graph()
-        G.add_node(index, pos=np.array([x, y, z]))
-                   
-        for count, (index, ntype, x, y, z, radius, parent) in enumerate(iter_points, index+1):
+@instrumented('swc2graph', counts=lambda G: {'nodes': len(G)})
+def swc2graph(swc_file, as_arrays=False):
+    '''Parse SWC file to valid graph (networkx or ArrayGraph) for `graph-mesh`'''
+    from .graph import ArrayGraph
 
-            assert count == index
+    data = read_swc(swc_file)
+    # Let downstream skip networkx
+    if as_arrays:
+        return ArrayGraph.from_swc(data)
 
-            G.add_node(index, pos=np.array([x, y, z]))
-            G.add_edge(index, parent, radius=radius, ntype=ntype)
+    G = nx.Graph()
+    G.add_nodes_from((index, {'pos': pos}) for index, pos in zip(data.index.tolist(), data.pos))
 
+    child, = np.where(data.parent != -1)
+    G.add_edges_from(zip(data.index[child].tolist(),
+                         data.parent[child].tolist(),
+                         ({'radius': r, 'ntype': t}
+                          for r, t in zip(data.radius[child].tolist(), data.ntype[child].tolist()))))
     return G
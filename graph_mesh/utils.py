@@ -5,44 +5,34 @@ import numpy as np
 def is_loop(mesh):
     '''No bifurcations'''
     assert mesh.topology().dim() == 1
-    
-    tdim = mesh.topology().dim()
-    _, f2c = mesh.init(tdim-1, tdim), mesh.topology()(tdim-1, tdim)
-    
-    return all(len(f2c(f)) == 2 for f in range(mesh.num_vertices()))
+
+    return bool(np.all(np.bincount(mesh.cells().ravel(), minlength=mesh.num_vertices()) == 2))
 
 
-def walk_vertices(arg, tag=None):
+def walk_vertices(arg, tag=None, index=None):
     '''Walk vertices in a linked way'''
-    assert isinstance(arg, df.Mesh) or isinstance(arg, df.MeshFunctionSizet)
-    # Branch
-    if isinstance(arg, df.MeshFunctionSizet):
-        mesh = arg.mesh()
-        assert arg.dim() == 1
-    else:
-        mesh = arg
-        
-    assert mesh.topology().dim() == 1 and mesh.geometry().dim() > 1
-    # The boring cese
-    assert mesh.num_cells() > 1
-    
-    c2v = mesh.topology()(1, 0)
+    index, color = _traversal(arg, tag, index)
 
-    cells = walk_cells(arg, tag=tag)
-    cell, orient = next(cells)
+    yield from index.branch_vertices(color).tolist()
 
-    vertices = c2v(cell) if orient else reversed(c2v(cell))
-    for v in vertices:
-        yield v
-    
-    for cell, orient in cells:
-        yield list(c2v(cell) if orient else reversed(c2v(cell)))[-1]
-        
 
-def walk_cells(arg, tag=None):
+def walk_cells(arg, tag=None, index=None):
     '''Walk loop mesh of tagged branch of mesh'''
     # We return cell index together with orientation, i.e. True if link
     # is v0, v1 False if link is v1, v0
+    index, color = _traversal(arg, tag, index)
+
+    yield from zip(index.branch_cells(color).tolist(),
+                   index.branch_orientations(color).tolist())
+
+
+def _traversal(arg, tag, index):
+    '''
+    Traversal index (branching.BranchTraversal) and the color to walk. Pass
+    in the index to avoid rebuilding it when walking many branches.
+    '''
+    from .branching import BranchTraversal
+
     assert isinstance(arg, df.Mesh) or isinstance(arg, df.MeshFunctionSizet)
     # Branch
     if isinstance(arg, df.MeshFunctionSizet):
@@ -50,53 +40,45 @@ def walk_cells(arg, tag=None):
         assert arg.dim() == 1
     else:
         mesh = arg
-        
+
     assert mesh.topology().dim() == 1 and mesh.geometry().dim() > 1
-    # THe boring cese
+    # The boring cese
     assert mesh.num_cells() > 1
-    
-    _, v2c = mesh.init(0, 1), mesh.topology()(0, 1)
-    c2v = mesh.topology()(1, 0)
 
-    def next_vertex(c, v, c2v=c2v):
-        v0, v1 = c2v(c)
-        return v1 if v == v0 else v0
+    if is_loop(mesh):
+        # Whole mesh is walked starting from the first cell
+        return BranchTraversal(mesh.cells(), np.zeros(mesh.num_cells(), dtype=np.int64)), 0
 
-    def next_cell(v, c, v2c=v2c):
-        c0, c1 = v2c(v)
-        return c1 if c == c0 else c0
+    assert tag is not None
+    if index is None:
+        index = BranchTraversal.from_cell_function(arg)
+    return index, tag
 
-    if is_loop(mesh):
-        link_cell = 0
-        # For loop we pick where to start as either of the first cell
-        start, v1 = c2v(link_cell)
-        # ... and we terminate once we reach the start again
-        end = start
-    else:
-        assert tag is not None
-        # If this is a branch we need two end cells/vertices
-        cell_indices, = np.where(arg.array() == tag)
-        
-        vertex2cell = defaultdict(set)
-        for cell_idx in cell_indices:
-            [vertex2cell[v].add(cell_idx) for v in c2v(cell_idx)]
-        # One is a start the other is end
-        start, end = [v for v in vertex2cell if len(vertex2cell[v]) == 1]
-        
-        link_cell, = vertex2cell[start]
-        # The linking vertex is not the start
-        v1,  = set(c2v(link_cell)) - set((start, ))
-        
-    yield link_cell, c2v(link_cell)[-1] == v1
-
-    v0 = start
-    while next_vertex(link_cell, v0) != end:
-        # -- v0 ==
-        v0 = next_vertex(link_cell, v0)
-        # Because we have not terminal, ==
-        link_cell = next_cell(v0, link_cell)
-
-        yield link_cell, c2v(link_cell)[0] == v0
+
+def vertex_to_cell_csr(cells, num_vertices=None):
+    '''CSR encoding (offsets, cell indices) of vertex to cell connectivity'''
+    cells = np.asarray(cells)
+    ncells, nvertices_cell = cells.shape
+    if num_vertices is None:
+        num_vertices = np.max(cells) + 1 if ncells else 0
+
+    flat = cells.ravel()
+    # Cells of vertex v are indices[offsets[v]:offsets[v+1]] in increasing order
+    indices = np.argsort(flat, kind='stable') // nvertices_cell
+    offsets = np.zeros(num_vertices+1, dtype=np.int64)
+    np.cumsum(np.bincount(flat, minlength=num_vertices), out=offsets[1:])
+
+    return offsets, indices
+
+
+def dofmap_array(V):
+    '''Cell to dofs map of V as (num_cells, num_cell_dofs) array'''
+    mesh = V.mesh()
+    tdim = mesh.topology().dim()
+    # For cells the closure dofs come in the local order of cell_dofs
+    dofs = np.asarray(V.dofmap().entity_closure_dofs(mesh, tdim), dtype=np.int64)
+
+    return dofs.reshape((mesh.num_cells(), -1))
 
 
 def PCA_axis(x):
@@ -0,0 +1,217 @@
+from collections import namedtuple
+from scipy.spatial import cKDTree
+from .graph import as_array_graph
+from .instrument import instrumented
+import numpy as np
+
+
+# Edge pairs (npairs x 2) which cross or are closer than tolerance (with
+# their distances) and pairs of nodes which coincide
+GraphReport = namedtuple('GraphReport', ('crossings', 'near_contacts', 'near_distances', 'duplicate_nodes'))
+
+
+def segment_distances(x, edges, pairs):
+    '''Distance between segments (edges) of each pair of edges'''
+    p1, q1 = x[edges[pairs[:, 0], 0]], x[edges[pairs[:, 0], 1]]
+    p2, q2 = x[edges[pairs[:, 1], 0]], x[edges[pairs[:, 1], 1]]
+
+    d1, d2, r = q1 - p1, q2 - p2, p1 - p2
+    a, e = np.sum(d1*d1, axis=1), np.sum(d2*d2, axis=1)
+    b, c, f = np.sum(d1*d2, axis=1), np.sum(d1*r, axis=1), np.sum(d2*r, axis=1)
+
+    def divide(num, den):
+        return np.divide(num, den, out=np.zeros_like(num), where=den > 0)
+
+    # Closest points p1 + s*d1, p2 + t*d2 (Ericson, Real-Time Collision Detection)
+    s = np.clip(divide(b*f - c*e, a*e - b*b), 0, 1)
+    t = divide(b*s + f, e)
+
+    below, above = t < 0, t > 1
+    t = np.clip(t, 0, 1)
+    s = np.where(below, np.clip(divide(-c, a), 0, 1), s)
+    s = np.where(above, np.clip(divide(b - c, a), 0, 1), s)
+
+    # Segments collapsed to points
+    eps = np.finfo(float).eps*np.maximum(a, e)
+    point1, point2 = a <= eps, e <= eps
+    s, t = np.where(point2, np.clip(divide(-c, a), 0, 1), s), np.where(point2, 0, t)
+    s, t = np.where(point1, 0, s), np.where(point1, np.clip(divide(f, e), 0, 1), t)
+
+    return np.linalg.norm(p1 + s[:, None]*d1 - p2 - t[:, None]*d2, axis=1)
+
+
+def candidate_pairs(x, edges, tol=0.):
+    '''
+    Pairs of edges whose bounding boxes (enlarged by tol) may intersect.
+    Edges are cut into pieces no longer than h - 2*tol where h is the cell
+    size of a uniform grid (the median edge length, at least 4*tol) and
+    binned by the grid cells their enlarged boxes touch. Edges which share a node are paired too.
+    '''
+    nedges = len(edges)
+    if nedges < 2:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    p, q = x[edges[:, 0]], x[edges[:, 1]]
+    lengths = np.linalg.norm(q - p, axis=1)
+    h = max(np.median(lengths), 4*tol, 1E-12*np.max(np.ptp(x, axis=0)), np.finfo(float).tiny)
+
+    npieces = np.maximum(np.ceil(lengths/(h - 2*tol)), 1).astype(np.int64)
+    piece_edge = np.repeat(np.arange(nedges), npieces)
+    k = np.arange(len(piece_edge)) - np.repeat(np.cumsum(npieces) - npieces, npieces)
+    # Piece bounds
+    d = (q - p)/npieces[:, None]
+    start = p[piece_edge] + k[:, None]*d[piece_edge]
+    end = start + d[piece_edge]
+
+    origin = np.min(x, axis=0) - tol
+    lo = np.floor((np.minimum(start, end) - tol - origin)/h).astype(np.int64)
+    hi = np.floor((np.maximum(start, end) + tol - origin)/h).astype(np.int64)
+    # Enlarged box of piece is no longer than cell so it touches at most 2
+    # cells in each direction
+    gdim = x.shape[1]
+    cells, cell_edges = [], []
+    for shift in np.ndindex(*(2, )*gdim):
+        cell = lo + np.array(shift)
+        inside = np.all(cell <= hi, axis=1)
+        cells.append(cell[inside])
+        cell_edges.append(piece_edge[inside])
+    entries = np.column_stack([np.vstack(cells), np.concatenate(cell_edges)])
+    # Sort by cell and then edge; pieces of an edge may share a cell
+    entries = entries[np.lexsort(entries.T[::-1])]
+    entries = entries[np.r_[True, np.any(entries[1:] != entries[:-1], axis=1)]]
+
+    # Groups of entries in the same cell; all pairs within the group
+    cell_change = np.r_[True, np.any(entries[1:, :-1] != entries[:-1, :-1], axis=1)]
+    group_start = np.flatnonzero(cell_change)
+    group_end = np.r_[group_start[1:], len(entries)]
+    group = np.cumsum(cell_change) - 1
+
+    counts = group_end[group] - np.arange(len(entries)) - 1
+    left = np.repeat(np.arange(len(entries)), counts)
+    right = left + 1 + np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    first, second = entries[left, -1], entries[right, -1]
+    first, second = np.minimum(first, second), np.maximum(first, second)
+    # Pair as single key for fast unique
+    keys = np.sort((first*nedges + second)[first != second])
+    keys = keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+
+    return np.column_stack([keys // nedges, keys % nedges])
+
+
+def fold_angles(x, edges, pairs):
+    '''
+    Angle at the shared node between edges of each pair (which share a
+    node). Small angle means the edges overlap, i.e. the graph folds back.
+    '''
+    e, f = edges[pairs[:, 0]], edges[pairs[:, 1]]
+    # Shared node is the one of e which is in f; with both shared the angle is 0
+    e0_shared = np.any(e[:, [0]] == f, axis=1)
+    shared = np.where(e0_shared, e[:, 0], e[:, 1])
+    e_far = np.where(e0_shared, e[:, 1], e[:, 0])
+    f_far = np.where(f[:, 0] == shared, f[:, 1], f[:, 0])
+
+    u, v = x[e_far] - x[shared], x[f_far] - x[shared]
+    cos = np.sum(u*v, axis=1)/np.maximum(np.linalg.norm(u, axis=1)*np.linalg.norm(v, axis=1), np.finfo(float).tiny)
+    return np.arccos(np.clip(cos, -1, 1))
+
+
+@instrumented('validate_graph', counts=lambda r: {'crossings': len(r.crossings),
+                                                  'near_contacts': len(r.near_contacts),
+                                                  'duplicate_nodes': len(r.duplicate_nodes)})
+def validate_graph(graph, near_tol=1E-3, cross_tol=1E-10, duplicate_tol=1E-10, fold_angle=1E-2):
+    '''
+    Find edges which cross (are closer than cross_tol), edges closer than
+    near_tol and nodes which coincide up to duplicate_tol. Tolerances are
+    relative to the size of the graph. Edges sharing a node are always
+    close; they count as crossing if the angle between them is below
+    fold_angle (they overlap) and their distance is reported as 0.
+    '''
+    graph = as_array_graph(graph)
+    x, edges = graph.pos, graph.edges.astype(np.int64)
+
+    size = np.max(np.ptp(x, axis=0)) if len(x) else 1.
+    size = size if size > 0 else 1.
+
+    pairs = candidate_pairs(x, edges, tol=max(near_tol, cross_tol)*size)
+    adjacent = np.any(edges[pairs[:, 0]][:, :, None] == edges[pairs[:, 1]][:, None, :], axis=(1, 2))
+
+    distances = np.zeros(len(pairs))
+    distances[~adjacent] = segment_distances(x, edges, pairs[~adjacent])
+
+    is_crossing = ~adjacent & (distances <= cross_tol*size)
+    is_crossing[adjacent] = fold_angles(x, edges, pairs[adjacent]) < fold_angle
+    is_near = ~adjacent & ~is_crossing & (distances <= near_tol*size)
+
+    duplicates = cKDTree(x).query_pairs(duplicate_tol*size, output_type='ndarray')
+
+    return GraphReport(crossings=pairs[is_crossing],
+                       near_contacts=pairs[is_near],
+                       near_distances=distances[is_near],
+                       duplicate_nodes=np.sort(duplicates, axis=1) if len(duplicates) else np.zeros((0, 2), dtype=np.int64))
+
+
+def check_graph(graph, near_tol=1E-3, cross_tol=1E-10, duplicate_tol=1E-10, fold_angle=1E-2):
+    '''Raise ValueError listing the offending edges/nodes of the graph if any'''
+    report = validate_graph(graph, near_tol=near_tol, cross_tol=cross_tol, duplicate_tol=duplicate_tol,
+                            fold_angle=fold_angle)
+
+    problems = []
+    for name, pairs in (('crossing edges', report.crossings),
+                        ('nearly touching edges', report.near_contacts),
+                        ('duplicate nodes', report.duplicate_nodes)):
+        if len(pairs):
+            shown = ', '.join(map(str, map(tuple, pairs[:10].tolist())))
+            problems.append(f'{len(pairs)} {name}: {shown}' + (' ...' if len(pairs) > 10 else ''))
+
+    if problems:
+        raise ValueError('Invalid graph for embedding; ' + '; '.join(problems))
+    return report
+
+# --------------------------------------------------------------------
+
+if __name__ == '__main__':
+    # Planar trees with many generations have children crossing the parents
+    from graph_mesh.generators import murray_tree
+    from graph_mesh.graph import ArrayGraph
+    import time
+
+    # Candidates cover all pairs within tol (brute force)
+    rng = np.random.default_rng(1)
+    for _ in range(100):
+        x = rng.random((40, 3))
+        edges = rng.integers(0, 40, (30, 2))
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        tol = 0.2
+        everything = np.column_stack(np.triu_indices(len(edges), 1))
+        close = everything[segment_distances(x, edges, everything) <= tol]
+        found = set(map(tuple, candidate_pairs(x, edges, tol).tolist()))
+        assert set(map(tuple, close.tolist())) <= found
+
+    # Collapsed edges (e.g. after resampling) against sampled distances
+    x = rng.random((20, 3))
+    x[10:] = x[:10]
+    edges = np.column_stack([np.arange(20), rng.integers(0, 20, 20)])
+    edges[:10, 1] = np.arange(10, 20)
+    everything = np.column_stack(np.triu_indices(len(edges), 1))
+    samples = np.linspace(0, 1, 401)
+    for (i, j), d in zip(everything, segment_distances(x, edges, everything)):
+        pi = x[edges[i, 0]] + samples[:, None]*(x[edges[i, 1]] - x[edges[i, 0]])
+        pj = x[edges[j, 0]] + samples[:, None]*(x[edges[j, 1]] - x[edges[j, 0]])
+        sampled = np.min(np.linalg.norm(pi[:, None] - pj[None], axis=2))
+        assert d - 1E-12 <= sampled <= d + 1E-2
+
+    # Edge folded back onto its neighbour
+    x = np.array([[0, 0, 0], [1, 0, 0], [0.5, 1E-4, 0], [0, 1, 0]])
+    report = validate_graph(ArrayGraph(x, np.array([[0, 1], [1, 2], [0, 3]])))
+    assert report.crossings.tolist() == [[0, 1]]
+
+    for generations in (8, 12, 16):
+        graph = murray_tree(generations, seed=1, as_arrays=True)
+
+        then = time.perf_counter()
+        report = validate_graph(graph)
+        elapsed = time.perf_counter() - then
+
+        print(f'{graph} crossings {len(report.crossings)} near {len(report.near_contacts)} '
+              f'duplicates {len(report.duplicate_nodes)} in {elapsed:.2f}s')